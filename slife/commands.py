@@ -0,0 +1,74 @@
+# Copyright (c) 2022, Slife
+# For license information, please see license.txt
+
+import click
+from frappe.commands import get_site, pass_context
+
+@click.command('slife-import-orders')
+@click.argument('path')
+@click.option('--workers', default=4, type=int, help='Number of worker processes')
+@click.option('--restart', is_flag=True, default=False, help='Ignore checkpoints from a previous run')
+@pass_context
+def import_orders(context, path, workers, restart):
+	"Import historical Woocommerce orders from a JSON lines or Woocommerce REST export file"
+	from slife.slife.bulk_import import import_orders
+
+	site = get_site(context)
+	result = import_orders(site, path, workers=workers, restart=restart)
+	click.echo("Imported {processed} orders, skipped {skipped}, failed {failed} in {seconds:.1f}s"
+		" ({rate:.2f} orders/second)".format(**result))
+
+@click.command('slife-benchmark')
+@click.option('--orders', default=100, type=int, help='Number of synthetic orders')
+@click.option('--mode', default='http', type=click.Choice(['http', 'direct']),
+	help='http: post to the webhook, direct: run _order in this process and count DB queries')
+@click.option('--concurrency', default=4, type=int, help='Concurrent requests in http mode')
+@click.option('--lines', default=1, type=int, help='Line items per order')
+@click.option('--attributes', default=None, type=int, help='Attributes varied per line, default all')
+@click.option('--variants', default=10, type=int, help='Distinct values per attribute')
+@click.option('--repeat-customers', default=0.5, type=float, help='Share of orders from earlier customers')
+@click.option('--addresses', default=1, type=int, help='Distinct addresses per customer')
+@click.option('--status', default=None, help='Order status, default from the fixture')
+@click.option('--seed', default=None, type=int)
+@click.option('--output', default=None, help='Write the results as JSON to this file')
+@pass_context
+def benchmark(context, orders, mode, concurrency, lines, attributes, variants, repeat_customers, addresses,
+	status, seed, output):
+	"Replay synthetic Woocommerce orders against a local bench site and report latency percentiles"
+	import json
+	import frappe
+	from slife.slife.benchmark import run
+
+	frappe.init(site=get_site(context))
+	frappe.connect()
+	try:
+		results = run(orders, mode=mode, concurrency=concurrency, output=output, lines=lines,
+			attributes=attributes, variants=variants, repeat_customers=repeat_customers,
+			addresses=addresses, status=status, seed=seed)
+	finally:
+		frappe.destroy()
+	click.echo(json.dumps(results, indent=1, default=str))
+
+@click.command('slife-replay-dead-letters')
+@click.argument('names', nargs=-1)
+@click.option('--all', 'replay_all', is_flag=True, default=False, help='Replay every Open letter')
+@click.option('--workers', default=4, type=int, help='Number of worker processes')
+@click.option('--attempts', default=5, type=int, help='Replay rounds of each letter')
+@click.option('--backoff', default=2, type=float, help='Seconds before the second round, doubled each round')
+@pass_context
+def replay_dead_letters(context, names, replay_all, workers, attempts, backoff):
+	"Replay Woocommerce Dead Letters through the order pipeline in parallel"
+	from slife.slife.doctype.woocommerce_dead_letter.woocommerce_dead_letter import replay_site
+
+	if not names and not replay_all:
+		raise click.UsageError('Pass the letter names or --all')
+	site = get_site(context)
+	result = replay_site(site, list(names) or None, workers=workers, attempts=attempts, backoff=backoff)
+	click.echo("Replayed {replayed} letters, failed {failed} in {seconds:.1f}s"
+		" ({rate:.2f} letters/second)".format(**result))
+
+commands = [
+	import_orders,
+	benchmark,
+	replay_dead_letters
+]
@@ -43,7 +43,7 @@ fixtures = [
 # page_js = {"page" : "public/js/file.js"}
 
 # include js in doctype views
-# doctype_js = {"doctype" : "public/js/doctype.js"}
+doctype_js = {"Sales Order" : "public/js/sales_order.js"}
 # doctype_list_js = {"doctype" : "public/js/doctype_list.js"}
 # doctype_tree_js = {"doctype" : "public/js/doctype_tree.js"}
 # doctype_calendar_js = {"doctype" : "public/js/doctype_calendar.js"}
@@ -89,6 +89,10 @@ fixtures = [
 # 	"Event": "frappe.desk.doctype.event.event.has_permission",
 # }
 
+# Links of these doctypes do not block deleting the linked document.
+# Timings are a log kept for KEEP_DAYS, they keep the name of a deleted Sales Order or Woocommerce Inbox entry
+ignore_links_on_delete = ["Woocommerce Order Timing"]
+
 # DocType Class
 # ---------------
 # Override standard doctype classes
@@ -108,30 +112,116 @@ doc_events = {
 #		"on_trash": "method"
 #	},
 	"Woocommerce Settings": {
-		"before_save": "slife.slife.woocommerce.settings_override"
+		"before_save": "slife.slife.woocommerce.settings_override",
+		"on_update": "slife.slife.cache.invalidate"
+	},
+	"Company": {
+		"on_update": "slife.slife.cache.invalidate",
+		"after_rename": "slife.slife.cache.invalidate",
+		"on_trash": "slife.slife.cache.invalidate"
+	},
+	"Warehouse": {
+		"on_update": "slife.slife.cache.invalidate",
+		"after_rename": "slife.slife.cache.invalidate",
+		"on_trash": "slife.slife.cache.invalidate"
+	},
+	"Country": {
+		"on_update": "slife.slife.cache.invalidate",
+		"after_rename": "slife.slife.cache.invalidate",
+		"on_trash": "slife.slife.cache.invalidate"
+	},
+	"System Settings": {
+		"on_update": "slife.slife.cache.invalidate"
+	},
+	"Accounts Settings": {
+		"on_update": "slife.slife.cache.invalidate"
+	},
+	"Item Tax Template": {
+		"on_update": "slife.slife.cache.invalidate_item_taxes",
+		"after_rename": "slife.slife.cache.invalidate_item_taxes",
+		"on_trash": "slife.slife.cache.invalidate_item_taxes"
+	},
+	"Item Group": {
+		"on_update": "slife.slife.cache.invalidate_item_taxes",
+		"after_rename": "slife.slife.cache.invalidate_item_taxes",
+		"on_trash": "slife.slife.cache.invalidate_item_taxes"
+	},
+	"Coupon Code": {
+		"on_update": "slife.slife.cache.invalidate_coupons",
+		"after_rename": "slife.slife.cache.invalidate_coupons",
+		"on_trash": "slife.slife.cache.invalidate_coupons"
+	},
+	"Pricing Rule": {
+		"on_update": "slife.slife.cache.invalidate_coupons",
+		"after_rename": "slife.slife.cache.invalidate_coupons",
+		"on_trash": "slife.slife.cache.invalidate_coupons"
+	},
+	"Item": {
+		"on_update": "slife.slife.cache.invalidate_item_template",
+		"after_rename": "slife.slife.cache.invalidate_item_template",
+		"on_trash": "slife.slife.cache.invalidate_item_template"
+	},
+	"Currency Exchange": {
+		"on_update": "slife.slife.cache.invalidate_exchange_rates",
+		"on_trash": "slife.slife.cache.invalidate_exchange_rates"
+	},
+	"Address": {
+		"validate": "slife.slife.woocommerce.set_address_key"
+	},
+	"Sales Order": {
+		"on_trash": [
+			"slife.slife.doctype.woocommerce_order_archive.woocommerce_order_archive.delete_archive",
+			"slife.slife.doctype.woocommerce_order_link.woocommerce_order_link.unlink_document"
+		]
+	},
+	"Sales Invoice": {
+		"on_trash": "slife.slife.doctype.woocommerce_order_link.woocommerce_order_link.unlink_document"
+	},
+	"Material Request": {
+		"on_trash": "slife.slife.doctype.woocommerce_order_link.woocommerce_order_link.unlink_document"
+	},
+	"Request for Quotation": {
+		"on_trash": "slife.slife.doctype.woocommerce_order_link.woocommerce_order_link.unlink_document"
+	},
+	"Item Variant Settings": {
+		"on_update": "slife.slife.cache.invalidate_item_template"
 	}
 }
 
 # Scheduled Tasks
 # ---------------
 
-# scheduler_events = {
-# 	"all": [
-# 		"slife.tasks.all"
-# 	],
-# 	"daily": [
-# 		"slife.tasks.daily"
-# 	],
-# 	"hourly": [
-# 		"slife.tasks.hourly"
-# 	],
+scheduler_events = {
+	"all": [
+		"slife.slife.doctype.woocommerce_inbox.woocommerce_inbox.requeue",
+		"slife.slife.doctype.woocommerce_order_link.woocommerce_order_link.retry_stages"
+	],
+	"daily": [
+		"slife.slife.cache.prewarm_exchange_rates",
+		"slife.slife.doctype.woocommerce_order_timing.woocommerce_order_timing.clear_old_timings",
+		"slife.slife.doctype.woocommerce_inbox.woocommerce_inbox.clear_old_entries",
+		"slife.slife.consolidation.consolidate_daily"
+	],
+	"hourly": [
+		"slife.slife.consolidation.consolidate_hourly",
+		"slife.slife.catalog.sync_catalog_hourly",
+		"slife.slife.reconcile.reconcile_hourly"
+	],
 # 	"weekly": [
 # 		"slife.tasks.weekly"
 # 	]
 # 	"monthly": [
 # 		"slife.tasks.monthly"
 # 	]
-# }
+}
+
+# Request & Job Events
+# --------------------
+# Warm up each process once, see slife.slife.warmup
+
+before_request = ["slife.slife.warmup.warm_up_request"]
+# Frappe v14+, on v13 the order jobs call warm_up themselves
+before_job = ["slife.slife.warmup.warm_up_job"]
 
 # Testing
 # -------
@@ -0,0 +1,29 @@
+import frappe
+
+from slife.slife.doctype.woocommerce_order_archive.woocommerce_order_archive import archive_order
+
+def execute():
+	"Move the Sales Order woocommerce_order_json custom field into the compressed Woocommerce Order Archive"
+	frappe.reload_doc('slife', 'doctype', 'woocommerce_order_archive')
+	if not frappe.db.has_column('Sales Order', 'woocommerce_order_json'):
+		return
+
+	last = ''
+	while True:
+		rows = frappe.db.sql("""select name, woocommerce_order_json from `tabSales Order`
+			where name > %s and ifnull(woocommerce_order_json, '') != ''
+			order by name limit 500""", last, as_dict=True)
+		if not rows:
+			break
+		for row in rows:
+			if not frappe.db.exists('Woocommerce Order Archive', row.name):
+				try:
+					order_key = frappe.parse_json(row.woocommerce_order_json).get('order_key')
+				except Exception:
+					order_key = None
+				archive_order(row.name, row.woocommerce_order_json, order_key)
+			last = row.name
+		frappe.db.commit()
+
+	frappe.delete_doc_if_exists('Custom Field', 'Sales Order-woocommerce_order_json')
+	frappe.db.sql_ddl("alter table `tabSales Order` drop column `woocommerce_order_json`")
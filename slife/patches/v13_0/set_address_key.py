@@ -0,0 +1,10 @@
+import frappe
+from frappe.modules.utils import sync_customizations
+
+def execute():
+	"Backfill the indexed Address woocommerce_address_key, see slife.slife.woocommerce.address_key"
+	sync_customizations('slife')
+	frappe.db.sql("""update `tabAddress` set woocommerce_address_key = concat(
+			lower(replace(pincode, ' ', '')), '|', lower(replace(country, ' ', ''))
+		)
+		where ifnull(replace(pincode, ' ', ''), '') != '' and ifnull(replace(country, ' ', ''), '') != ''""")
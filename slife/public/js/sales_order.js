@@ -0,0 +1,29 @@
+// Copyright (c) 2022, Slife
+// For license information, please see license.txt
+
+frappe.ui.form.on('Sales Order', {
+	refresh: function(frm) {
+		if (frm.doc.__islocal || !frm.doc.po_no) {
+			return;
+		}
+		frm.add_custom_button(__('Woocommerce Order'), function() {
+			// The order JSON is archived outside the Sales Order and only loaded when asked for
+			frappe.call({
+				method: 'slife.slife.doctype.woocommerce_order_archive.woocommerce_order_archive.get_order_json',
+				args: {sales_order: frm.doc.name}
+			}).then(r => {
+				if (!r.message) {
+					frappe.msgprint(__('No Woocommerce order is archived for this Sales Order'));
+					return;
+				}
+				const dialog = new frappe.ui.Dialog({
+					title: __('Woocommerce Order JSON'),
+					size: 'large',
+					fields: [{fieldname: 'json', fieldtype: 'Code', options: 'JSON', read_only: 1}]
+				});
+				dialog.set_value('json', JSON.stringify(JSON.parse(r.message), null, 4));
+				dialog.show();
+			});
+		}, __('View'));
+	}
+});
@@ -0,0 +1,202 @@
+# Copyright (c) 2022, Slife
+# For license information, please see license.txt
+
+"""
+Load testing and benchmarks for the Woocommerce order webhook, see `bench --site <site> slife-benchmark`.
+Run against a local bench site configured as described in test_woocommerce, never a production site.
+
+Synthetic orders are generated from the test order fixtures and either
+ - http: signed like test_woocommerce.send_order and posted concurrently to the webhook,
+   measuring the request latency, the end to end latency from the Woocommerce Inbox and
+   DB queries per order from the Woocommerce Order Timing log, or
+ - direct: run through _order in this process, measuring latency and DB queries per order.
+Results are returned and optionally written as JSON to compare releases.
+"""
+
+import json
+import random
+import time
+
+import frappe
+
+from slife.slife.timing import percentiles
+
+ATTRIBUTE_PREFIX = '_uni_item_'
+# Streets of a customer's addresses. They share the fixture postcode, so the same address key, yet differ enough
+# for woocommerce.same_address to tell them apart. Beyond these the postcode varies too
+STREETS = ('Benchmark Street', 'Harbour Road', 'Orchard Lane', 'Kingsway Avenue', 'Mill Close', 'Station Parade',
+	'Victoria Crescent', 'Elmwood Drive')
+
+def generate_orders(count, lines=1, attributes=None, repeat_customers=0.5, addresses=1, variants=10,
+	status=None, fixture='test_order_4.json', seed=None):
+	"""
+	Yield synthetic orders based on a test order fixture.
+	lines: line items per order
+	attributes: number of the fixture's numeric attributes to vary, None for all
+	repeat_customers: share of orders placed by an earlier customer instead of a new one
+	addresses: distinct addresses used by each customer
+	variants: distinct values per varied attribute, lower values create fewer new Items
+	"""
+	from pathlib import Path
+
+	rng = random.Random(seed)
+	with Path(__file__).with_name(fixture).open('r') as f:
+		base = json.load(f)
+	customers = []
+
+	for n in range(count):
+		order = json.loads(json.dumps(base))
+		order['id'] = order['number'] = 100000 + n
+		order['order_key'] = f'wc_order_{frappe.generate_hash(length=13)}'
+		if status:
+			order['status'] = status
+
+		if customers and rng.random() < repeat_customers:
+			customer = rng.choice(customers)
+		else:
+			customer = len(customers)
+			customers.append(customer)
+		order['billing'].update({
+			'first_name': 'Bench',
+			'last_name': f'Customer {customer}',
+			'company': '',
+			'email': f'bench{customer}@example.com'
+		})
+		order['billing'].update(benchmark_address(rng.randrange(addresses), order['billing'].get('postcode')))
+
+		order['line_items'] = []
+		for i in range(lines):
+			line = json.loads(json.dumps(base['line_items'][i % len(base['line_items'])]))
+			line['id'] = i + 1
+			line['quantity'] = rng.randint(1, 3)
+			line['subtotal'] = line['total'] = line['price'] * line['quantity']
+			vary_attributes(line, attributes, variants, rng)
+			order['line_items'].append(line)
+
+		order['total'] = sum(line['total'] for line in order['line_items']) + float(order.get('shipping_total') or 0)
+		yield order
+
+def benchmark_address(n, postcode):
+	"The address_1 and postcode of a customer's nth address"
+	street = STREETS[n % len(STREETS)]
+	if n >= len(STREETS):
+		postcode = f'{postcode}{n // len(STREETS)}'
+	return {'address_1': f'{n + 1} {street}', 'postcode': postcode}
+
+def vary_attributes(line, attributes, variants, rng):
+	"Change the numeric attribute values of a line item so it resolves to one of `variants` Items per attribute"
+	numeric = [meta for meta in line['meta_data']
+		if meta['key'].startswith(ATTRIBUTE_PREFIX) and meta['value'].rpartition('_')[2].isdigit()]
+	for meta in numeric[:attributes]:
+		human, sep, value = meta['value'].rpartition('_')
+		meta['value'] = meta['display_value'] = f'{human}{sep}{int(value) + rng.randrange(variants)}'
+
+def sign(secret, text):
+	"Woocommerce webhook signature of a payload"
+	import base64, hashlib, hmac
+	return base64.b64encode(hmac.new(secret.encode('utf8'), text.encode('utf8'), hashlib.sha256).digest())
+
+def replay_http(orders, concurrency=4, timeout=600):
+	"Post the orders concurrently to the webhook and wait for the workers to process them"
+	import requests
+	from concurrent.futures import ThreadPoolExecutor
+
+	secret = frappe.get_doc('Woocommerce Settings').secret
+	url = frappe.utils.get_site_url(frappe.local.site) + '/api/method/slife.slife.woocommerce.order'
+
+	def send(text):
+		headers = {
+			'X-Frappe-CSRF-Token': 'None',
+			'x-wc-webhook-event': 'created',
+			'x-wc-webhook-resource': 'order',
+			'x-wc-webhook-signature': sign(secret, text)
+		}
+		start = time.perf_counter()
+		r = requests.post(url, headers=headers, data=text)
+		r.raise_for_status()
+		return time.perf_counter() - start, r.json().get('message')
+
+	texts = [json.dumps(order) for order in orders]
+	start = time.perf_counter()
+	with ThreadPoolExecutor(concurrency) as pool:
+		sent = list(pool.map(send, texts))
+	inbox = wait_for_inbox([name for latency, name in sent], timeout)
+	seconds = time.perf_counter() - start
+
+	processed = [row for row in inbox if row.status == 'Processed']
+	# Recorded by the workers when Woocommerce Settings record_timings is set
+	queries = frappe.get_all('Woocommerce Order Timing', filters={'inbox': ('in', [row.name for row in processed])},
+		pluck='queries')
+	return {
+		'orders': len(texts),
+		'failed': len([row for row in inbox if row.status == 'Failed']),
+		'seconds': seconds,
+		'orders_per_second': len(processed) / seconds if seconds else 0,
+		'request_latency': percentiles([latency for latency, name in sent]),
+		'latency': percentiles([(row.finished - row.creation).total_seconds() for row in processed]),
+		'queries_per_order': percentiles(queries)
+	}
+
+def wait_for_inbox(names, timeout=600):
+	"Poll the Woocommerce Inbox until all entries are processed, failed or superseded"
+	deadline = time.monotonic() + timeout
+	while True:
+		# Start a new transaction to see the workers' commits
+		frappe.db.rollback()
+		rows = frappe.get_all('Woocommerce Inbox', filters={'name': ('in', names)},
+			fields=['name', 'status', 'creation', 'finished'])
+		if all(row.status in ('Processed', 'Failed', 'Superseded') for row in rows) or time.monotonic() > deadline:
+			return rows
+		time.sleep(1)
+
+def replay_direct(orders):
+	"Run the orders through _order in this process, one transaction per order"
+	from slife.slife.timing import count_queries
+	from slife.slife.woocommerce import _order
+
+	latencies, queries, failed = [], [], 0
+	start = time.perf_counter()
+	for order in orders:
+		order_start = time.perf_counter()
+		with count_queries() as counter:
+			try:
+				_order(json.dumps(order), 'created')
+				frappe.db.commit()
+			except Exception:
+				frappe.db.rollback()
+				failed += 1
+				continue
+		latencies.append(time.perf_counter() - order_start)
+		queries.append(counter.count)
+	seconds = time.perf_counter() - start
+
+	return {
+		'orders': len(latencies) + failed,
+		'failed': failed,
+		'seconds': seconds,
+		'orders_per_second': len(latencies) / seconds if seconds else 0,
+		'latency': percentiles(latencies),
+		'queries_per_order': percentiles(queries)
+	}
+
+def run(count=100, mode='http', concurrency=4, output=None, **generator_args):
+	"Generate and replay orders, returning the results and writing them to output as JSON"
+	from slife import __version__
+
+	orders = list(generate_orders(count, **generator_args))
+	if mode == 'direct':
+		results = replay_direct(orders)
+	else:
+		results = replay_http(orders, concurrency)
+
+	results.update({
+		'mode': mode,
+		'concurrency': concurrency if mode != 'direct' else 1,
+		'parameters': generator_args,
+		'version': __version__,
+		'timestamp': frappe.utils.now()
+	})
+	if output:
+		with open(output, 'w') as f:
+			json.dump(results, f, indent=1, default=str)
+	return results
@@ -0,0 +1,152 @@
+# Copyright (c) 2022, Slife
+# For license information, please see license.txt
+
+"""
+Bulk import of historical Woocommerce orders, see `bench --site <site> slife-import-orders`.
+
+Orders are run through the same _order logic as the webhook, without a request, as created events.
+Completed orders are imported as processing ones: the Sales Order is submitted, its Sales Invoice & RFQ are
+created by the stage jobs and the completed status applied afterwards. Cancelled, refunded and other orders
+that create no Sales Order, and orders already imported, are counted as skipped.
+Each worker process reads the whole file and handles the orders of its own partition,
+partitioned by billing email so the same customer is never written by two workers at once.
+Progress is checkpointed per partition next to the file so a restart skips finished orders.
+"""
+
+import json
+import time
+import zlib
+
+import frappe
+
+# Orders between checkpoint writes. Orders re-run after a crash are skipped by the Woocommerce Order Link
+CHECKPOINT_EVERY = 50
+# Characters read from the file at a time, see read_orders
+CHUNK_SIZE = 1 << 20
+
+def import_orders(site, path, workers=4, restart=False):
+	"Import all orders in the file with a pool of worker processes. Returns totals and orders/second"
+	from multiprocessing import Pool
+
+	start = time.monotonic()
+	args = [(site, path, partition, workers, restart) for partition in range(workers)]
+	if workers > 1:
+		with Pool(workers) as pool:
+			results = pool.starmap(import_partition, args)
+	else:
+		results = [import_partition(*args[0])]
+
+	result = {key: sum(r[key] for r in results) for key in ('processed', 'skipped', 'failed')}
+	result['seconds'] = time.monotonic() - start
+	result['rate'] = result['processed'] / result['seconds'] if result['seconds'] else 0
+	return result
+
+def import_partition(site, path, partition, partitions, restart=False):
+	"Worker process: import the orders of one partition"
+	from slife.slife import timing
+	from slife.slife.doctype.woocommerce_dead_letter.woocommerce_dead_letter import dead_letter
+	from slife.slife.locks import acquire, order_lock_keys, release_all
+	from slife.slife.woocommerce import _order
+
+	frappe.init(site=site)
+	frappe.connect()
+	try:
+		frappe.set_user(frappe.db.get_single_value('Woocommerce Settings', 'creation_user') or 'Administrator')
+		checkpoint = {'done': 0} if restart else read_checkpoint(path, partition)
+		result = {'processed': 0, 'skipped': 0, 'failed': 0}
+
+		index = 0
+		for order in read_orders(path):
+			if get_partition(order, partitions) != partition:
+				continue
+			index += 1
+			if index <= checkpoint['done']:
+				result['skipped'] += 1
+				continue
+
+			try:
+				# The customer can also be written by webhook workers
+				if not acquire(order_lock_keys(order)):
+					raise frappe.QueryTimeoutError('Timed out waiting for the customer lock of the order')
+				timing.start()
+				sales_order = _order(json.dumps(order), 'created')
+			except Exception as e:
+				frappe.db.rollback()
+				dead_letter(json.dumps(order), e, timing.failed_stage())
+				result['failed'] += 1
+			else:
+				result['processed' if sales_order else 'skipped'] += 1
+			frappe.db.commit()
+			release_all()
+
+			checkpoint['done'] = index
+			if index % CHECKPOINT_EVERY == 0:
+				write_checkpoint(path, partition, checkpoint)
+		write_checkpoint(path, partition, checkpoint)
+		return result
+	finally:
+		frappe.destroy()
+
+def read_orders(path):
+	"""
+	Stream orders from a file of JSON values: orders, or lists of orders such as the pages returned by the
+	Woocommerce REST API, one per line or a single list over many lines. Lists are read an order at a time
+	"""
+	decoder = json.JSONDecoder()
+	with open(path, 'r') as f:
+		buffer, pos, eof = '', 0, False
+		in_list = False
+		while True:
+			# Skip whitespace, and the brackets & commas of a list
+			while pos < len(buffer):
+				char = buffer[pos]
+				if char.isspace() or (in_list and char == ','):
+					pos += 1
+				elif char == '[' and not in_list:
+					in_list = True
+					pos += 1
+				elif char == ']' and in_list:
+					in_list = False
+					pos += 1
+				else:
+					break
+			if pos == len(buffer):
+				if eof:
+					return
+				buffer, pos = f.read(CHUNK_SIZE), 0
+				eof = not buffer
+				continue
+
+			try:
+				order, end = decoder.raw_decode(buffer, pos)
+			except ValueError:
+				if eof:
+					raise
+				end = len(buffer)
+			if end == len(buffer) and not eof:
+				# The order may go on in the next chunk
+				chunk = f.read(CHUNK_SIZE)
+				eof = not chunk
+				buffer, pos = buffer[pos:] + chunk, 0
+				continue
+			yield order
+			pos = end
+
+def get_partition(order, partitions):
+	"Stable partition number for the order billing email"
+	email = (order.get('billing') or {}).get('email') or ''
+	return zlib.crc32(email.strip().lower().encode('utf8')) % partitions
+
+def checkpoint_path(path, partition):
+	return f'{path}.checkpoint-{partition}'
+
+def read_checkpoint(path, partition):
+	try:
+		with open(checkpoint_path(path, partition), 'r') as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return {'done': 0}
+
+def write_checkpoint(path, partition, checkpoint):
+	with open(checkpoint_path(path, partition), 'w') as f:
+		json.dump(checkpoint, f)
@@ -0,0 +1,279 @@
+# Copyright (c) 2022, Slife
+# For license information, please see license.txt
+
+"""
+Process-wide cache of static configuration used by the Woocommerce order pipeline.
+
+Values are kept in worker memory per site. Saving a Woocommerce Settings, Company, Warehouse,
+Country, System Settings or Accounts Settings doc bumps a version number in Redis (see hooks.py doc_events), which
+clears the cache of every process the next time it is used. Cached values and docs must be treated as read only.
+"""
+
+from collections import OrderedDict
+
+import frappe
+
+VERSION_KEY = 'slife_cache_version'
+# Item templates are cached separately in a bounded LRU, invalidated by template Item changes
+TEMPLATE_VERSION_KEY = 'slife_template_version'
+TEMPLATE_CACHE_SIZE = 256
+# Item tax templates & rates resolved per item tax rows, tax category, company & date.
+# Invalidated by Item Tax Template and Item Group changes, Item changes alter the tax rows of the key
+TAX_VERSION_KEY = 'slife_tax_version'
+TAX_CACHE_SIZE = 1024
+# Coupon codes of enabled pricing rules, invalidated by Coupon Code and Pricing Rule changes
+COUPON_VERSION_KEY = 'slife_coupon_version'
+# Exchange rates are shared by all processes in Redis, keyed by date
+EXCHANGE_RATE_EXPIRY = 2 * 24 * 60 * 60 # seconds
+_caches = {}
+
+def _get_cache(version_key=VERSION_KEY):
+	"The cache dict for the current site, emptied if another process invalidated it"
+	version = frappe.cache().get_value(version_key)
+	key = (frappe.local.site, version_key)
+	cache = _caches.get(key)
+	if cache is None or cache['version'] != version:
+		cache = _caches[key] = {'version': version, 'lru': OrderedDict()}
+	return cache
+
+def get_cached(key, compute):
+	"Get a value from the process cache, calling compute() on a miss"
+	cache = _get_cache()
+	if key not in cache:
+		cache[key] = compute()
+	return cache[key]
+
+def invalidate(doc=None, method=None, *args):
+	"Clear the cache in all processes. Called from doc_events"
+	clear()
+	# Also clear after the commit so other processes can't cache the pre-commit values
+	frappe.enqueue('slife.slife.cache.clear', queue='short', enqueue_after_commit=True)
+
+def clear(version_key=VERSION_KEY):
+	_caches.pop((frappe.local.site, version_key), None)
+	frappe.cache().set_value(version_key, frappe.generate_hash(length=10))
+
+def invalidate_item_template(doc, method=None, *args):
+	"Clear the item template cache when a template Item is saved, renamed or deleted. Called from doc_events"
+	if doc.doctype == 'Item' and not doc.get('has_variants'):
+		return
+	clear(TEMPLATE_VERSION_KEY)
+	frappe.enqueue('slife.slife.cache.clear', queue='short', enqueue_after_commit=True,
+		version_key=TEMPLATE_VERSION_KEY)
+
+def get_item_template(code):
+	"Variant template metadata by SKU from a bounded LRU cache, see load_item_template"
+	return get_lru(TEMPLATE_VERSION_KEY, code, lambda: load_item_template(code), TEMPLATE_CACHE_SIZE)
+
+def get_lru(version_key, key, compute, size):
+	"Get a value from a bounded LRU process cache, calling compute() on a miss"
+	lru = _get_cache(version_key)['lru']
+	if key in lru:
+		lru.move_to_end(key)
+		return lru[key]
+
+	value = lru[key] = compute()
+	if len(lru) > size:
+		lru.popitem(last=False)
+	return value
+
+def load_item_template(code):
+	"""
+	The template Item fields needed to build a variant: name, item_name, description, variant_based_on,
+	the set of allowed attributes and the field values copied to each variant
+	(as erpnext.controllers.item_variant.copy_attributes_to_variant does)
+	"""
+	template = frappe.get_doc('Item', {'name': code, 'has_variants': True})
+
+	exclude_fields = ["naming_series", "item_code", "item_name", "show_in_website",
+		"show_variant_in_website", "opening_stock", "variant_of", "valuation_rate"]
+	if template.variant_based_on == 'Manufacturer':
+		# don't copy manufacturer values if based on part no
+		exclude_fields += ['manufacturer', 'manufacturer_part_no']
+
+	allow_fields = [d.field_name for d in frappe.get_all("Variant Field", fields=['field_name'])]
+	if "variant_based_on" not in allow_fields:
+		allow_fields.append("variant_based_on")
+
+	copy_fields = {}
+	for field in template.meta.fields:
+		if (field.reqd or field.fieldname in allow_fields) and field.fieldname not in exclude_fields:
+			if field.fieldtype == "Table":
+				copy_fields[field.fieldname] = [row.as_dict(no_default_fields=True)
+					for row in template.get(field.fieldname)]
+			else:
+				copy_fields[field.fieldname] = template.get(field.fieldname)
+
+	return frappe._dict({
+		'name': template.name,
+		'item_name': template.item_name,
+		'description': template.description,
+		'variant_based_on': template.variant_based_on,
+		'attributes': {attr.attribute for attr in template.attributes},
+		'copy_description': 'description' in allow_fields,
+		'copy_fields': copy_fields
+	})
+
+def invalidate_item_taxes(doc=None, method=None, *args):
+	"Clear the item tax cache in all processes. Called from Item Tax Template & Item Group doc_events"
+	clear(TAX_VERSION_KEY)
+	frappe.enqueue('slife.slife.cache.clear', queue='short', enqueue_after_commit=True,
+		version_key=TAX_VERSION_KEY)
+
+def get_item_tax(taxes, tax_category, company, transaction_date):
+	"""
+	The Item Tax Template and its tax map JSON for an item's tax rows, as erpnext set_child_tax_template_and_map
+	resolves them. Variants share their template's rows so all the items of a template hit the same entry.
+	"""
+	key = (tuple((tax.get('item_tax_template'), tax.get('tax_category'), str(tax.get('valid_from') or ''),
+		tax.get('minimum_net_rate'), tax.get('maximum_net_rate')) for tax in taxes),
+		tax_category, company, str(transaction_date))
+	return get_lru(TAX_VERSION_KEY, key,
+		lambda: load_item_tax(taxes, tax_category, company, transaction_date), TAX_CACHE_SIZE)
+
+def load_item_tax(taxes, tax_category, company, transaction_date):
+	from erpnext.stock.get_item_details import _get_item_tax_template, get_item_tax_map
+
+	args = {'posting_date': transaction_date, 'tax_category': tax_category, 'company': company}
+	template = _get_item_tax_template(args, taxes, out={})
+	return template, get_item_tax_map(company, template, as_json=True) if template else None
+
+def invalidate_coupons(doc=None, method=None, *args):
+	"Clear the coupon index in all processes. Called from Coupon Code & Pricing Rule doc_events"
+	if doc and doc.doctype == 'Coupon Code' and not coupon_changed(doc):
+		return
+	clear(COUPON_VERSION_KEY)
+	frappe.enqueue('slife.slife.cache.clear', queue='short', enqueue_after_commit=True,
+		version_key=COUPON_VERSION_KEY)
+
+def coupon_changed(doc):
+	"False when only the usage count changed, as on each submitted order using the coupon"
+	before = doc.get_doc_before_save()
+	if not before:
+		return True
+	return any(before.get(field) != doc.get(field)
+		for field in ('coupon_code', 'pricing_rule', 'valid_from', 'valid_upto', 'maximum_use'))
+
+def get_coupon_index():
+	"""
+	The coupons of enabled pricing rules by lower case code, Woocommerce lower cases its coupon codes.
+	Each coupon is indexed by its code and its name. The used count isn't indexed, see get_active_coupon
+	"""
+	cache = _get_cache(COUPON_VERSION_KEY)
+	if 'index' not in cache:
+		cache['index'] = load_coupon_index()
+	return cache['index']
+
+def load_coupon_index():
+	coupons = frappe.db.sql("""select coupon.name, coupon.coupon_code, coupon.pricing_rule, coupon.maximum_use,
+			coupon.valid_from, coupon.valid_upto, rule.company, rule.valid_from as rule_valid_from,
+			rule.valid_upto as rule_valid_upto
+		from `tabCoupon Code` coupon
+		inner join `tabPricing Rule` rule on rule.name = coupon.pricing_rule
+		where rule.disable = 0""", as_dict=True)
+
+	index = {}
+	for coupon in coupons:
+		for code in (coupon.coupon_code, coupon.name):
+			if code:
+				index.setdefault(code.strip().lower(), coupon)
+	return index
+
+def get_active_coupon(codes, company, transaction_date):
+	"""
+	The name of the first of the codes that is an active coupon for the company, or None. The coupon validity
+	is checked against today, as erpnext validate_coupon_code does even for back-dated orders, and its pricing
+	rule validity against the transaction date, as the pricing rule is looked up.
+	Only the used count of a limited coupon is read from the DB
+	"""
+	from frappe.utils import getdate
+
+	today = getdate()
+	transaction_date = getdate(transaction_date)
+	index = get_coupon_index()
+	for code in codes:
+		coupon = index.get((code or '').strip().lower())
+		if not coupon or (coupon.company and coupon.company != company):
+			continue
+		if (coupon.valid_from and getdate(coupon.valid_from) > today
+			or coupon.valid_upto and getdate(coupon.valid_upto) < today):
+			continue
+		if (coupon.rule_valid_from and getdate(coupon.rule_valid_from) > transaction_date
+			or coupon.rule_valid_upto and getdate(coupon.rule_valid_upto) < transaction_date):
+			continue
+		if coupon.maximum_use and frappe.db.get_value('Coupon Code', coupon.name, 'used') >= coupon.maximum_use:
+			continue
+		return coupon.name
+
+def get_accounts_setting(fieldname):
+	"A field of Accounts Settings, e.g. add_taxes_from_item_tax_template"
+	return get_cached(('Accounts Settings', fieldname),
+		lambda: frappe.db.get_single_value('Accounts Settings', fieldname))
+
+def get_settings():
+	"The Woocommerce Settings doc"
+	return get_cached('settings', lambda: frappe.get_doc('Woocommerce Settings'))
+
+def get_company_value(company, fieldname):
+	"A field of the Company, e.g. default_currency, cost_center or payment_terms"
+	return get_cached(('Company', company, fieldname),
+		lambda: frappe.db.get_value('Company', company, fieldname))
+
+def get_default_warehouse(company):
+	"The company Stores warehouse used when Woocommerce Settings has no warehouse"
+	return get_cached(('default_warehouse', company),
+		lambda: frappe.get_value('Warehouse', {'company': company, 'name': ('like', 'Stores%')}, 'name'))
+
+def get_default_country():
+	"The System Settings country"
+	return get_cached('default_country', lambda: frappe.db.get_single_value('System Settings', 'country'))
+
+def get_country(code):
+	"Country name by lower case ISO code, or None"
+	return get_cached(('Country', code), lambda: frappe.get_value("Country", {"code": code}))
+
+def get_exchange_rate(from_currency, to_currency, transaction_date=None):
+	"erpnext get_exchange_rate cached in Redis per day, counting hits and misses"
+	from frappe.utils import nowdate
+	from erpnext.setup.utils import get_exchange_rate
+
+	transaction_date = str(transaction_date or nowdate())
+	name = f'slife_exchange_rate:{transaction_date}'
+	key = f'{from_currency}:{to_currency}'
+	rate = frappe.cache().hget(name, key)
+	if rate:
+		_count('slife_exchange_rate_hits')
+		return rate
+
+	_count('slife_exchange_rate_misses')
+	rate = get_exchange_rate(from_currency, to_currency, transaction_date)
+	if rate:
+		frappe.cache().hset(name, key, rate)
+		frappe.cache().expire(frappe.cache().make_key(name), EXCHANGE_RATE_EXPIRY)
+	return rate
+
+def prewarm_exchange_rates():
+	"Scheduler: cache today's rate from every enabled currency to the Woocommerce company currency"
+	company = get_settings().company
+	if not company:
+		return
+	company_currency = get_company_value(company, 'default_currency')
+	for currency in frappe.get_all('Currency', filters={'enabled': 1}, pluck='name'):
+		if currency != company_currency:
+			get_exchange_rate(currency, company_currency)
+
+def invalidate_exchange_rates(doc=None, method=None, *args):
+	"Drop all cached exchange rates. Called from Currency Exchange doc_events"
+	frappe.cache().delete_keys('slife_exchange_rate:')
+
+@frappe.whitelist()
+def get_exchange_rate_stats():
+	"Exchange rate cache hits and misses since the counters were last reset"
+	frappe.only_for('System Manager')
+	return {
+		'hits': frappe.utils.cint(frappe.cache().get(frappe.cache().make_key('slife_exchange_rate_hits'))),
+		'misses': frappe.utils.cint(frappe.cache().get(frappe.cache().make_key('slife_exchange_rate_misses')))
+	}
+
+def _count(key):
+	frappe.cache().incr(frappe.cache().make_key(key))
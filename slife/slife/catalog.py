@@ -0,0 +1,152 @@
+# Copyright (c) 2022, Slife
+# For license information, please see license.txt
+
+"""
+Catalog sync. Creates the Items of Woocommerce products ahead of their first order so the
+order path finds them with a read. Simple products become Items, variable products an Item
+template with a variant per variation, using the same code & name rules as orders, see make_item.
+Products modified since the last sync are read from the REST API, the watermark is kept in
+Slife Settings catalog_modified_after.
+
+Woocommerce attributes map to the Item Attribute of the same name: the taxonomy slug without its pa_ prefix for
+global attributes, e.g. pa_size is size, the name for custom product attributes. Variations are passed to make_item
+with the meta_data keys orders carry, the attribute prefixed with Woocommerce Settings attribute_key_prefix.
+
+Variants of configurable products with free attribute values, e.g. dimensions entered by the
+customer, cannot be listed in advance and are still created by the first order.
+"""
+
+import frappe
+
+def sync_catalog_hourly():
+	"Scheduler: sync the catalog when Woocommerce Settings sync_catalog is set"
+	from slife.slife.cache import get_settings
+	if get_settings().sync_catalog:
+		sync_catalog()
+
+def sync_catalog():
+	"Create the Items of the products modified since the last sync. Returns the number of products synced"
+	from frappe.utils import get_datetime
+	from slife.slife.wc_api import get_api
+	from slife.slife import woocommerce
+	from slife.slife.cache import get_default_warehouse, get_settings
+
+	woocommerce.woocommerce_settings = get_settings()
+	default_wh = get_default_warehouse(woocommerce.woocommerce_settings.company)
+	api = get_api()
+	attributes = get_attributes(api)
+
+	params = {'dates_are_gmt': 'true', 'orderby': 'modified', 'order': 'asc'}
+	modified_after = frappe.db.get_single_value('Slife Settings', 'catalog_modified_after')
+	if modified_after:
+		params['modified_after'] = get_datetime(modified_after).isoformat()
+
+	watermark, failed, count = modified_after, False, 0
+	for product in api.get_all('products', **params):
+		frappe.db.savepoint('slife_catalog')
+		try:
+			sync_product(api, product, attributes, default_wh)
+		except Exception:
+			frappe.db.rollback(save_point='slife_catalog')
+			frappe.log_error(f"{frappe.get_traceback()}\n\n Product: {product.get('id')} {product.get('sku')}",
+				"WooCommerce Catalog Sync Error")
+			failed = True
+		else:
+			count += 1
+		frappe.db.commit()
+		if not failed and product.get('date_modified_gmt'):
+			# Only advanced up to the first failure, failed products are synced again by the next run
+			watermark = get_datetime(product['date_modified_gmt'])
+	frappe.db.set_value('Slife Settings', None, 'catalog_modified_after', watermark)
+	frappe.db.commit()
+	return count
+
+def get_attributes(api):
+	"Global product attributes by id: their taxonomy slug, e.g. pa_size, and the slug of each term by name"
+	attributes = {}
+	for attribute in api.get_all('products/attributes'):
+		attributes[attribute['id']] = frappe._dict(
+			slug=attribute['slug'],
+			terms={term['name']: term['slug'] for term in api.get_all(f"products/attributes/{attribute['id']}/terms")}
+		)
+	return attributes
+
+def sync_product(api, product, attributes, default_wh):
+	"Insert the Items of a product that do not exist yet"
+	from slife.slife.cache import get_settings
+	from slife.slife.woocommerce import insert_missing_items, make_item
+
+	if not product.get('sku'):
+		# Orders are matched by sku
+		return
+	if product.get('type') == 'variable':
+		if not frappe.db.exists('Item', product['sku']) and not make_template(product, attributes):
+			return
+		prefix = get_settings().attribute_key_prefix or ''
+		line_items = [variation_line_item(product, variation, attributes, prefix)
+			for variation in api.get_all(f"products/{product['id']}/variations")]
+		items = [make_item(item, default_wh) for item in line_items if item]
+	else:
+		items = [make_item(product_line_item(product), default_wh)]
+	insert_missing_items(items)
+
+def product_line_item(product):
+	"An order line item of a simple product, as passed to make_item"
+	return {'sku': product.get('sku'), 'name': product.get('name'), 'meta_data': []}
+
+def variation_line_item(product, variation, attributes, prefix):
+	"""
+	An order line item of a product variation, as passed to make_item. The attributes are meta_data keyed by
+	prefix + Item Attribute name, see attribute_name, with the term slug of global attributes as value.
+	None if the variation has an "Any" attribute, its variants are created by orders.
+	"""
+	meta_data = []
+	for attribute in variation.get('attributes') or []:
+		if not attribute.get('option'):
+			return None
+		global_attribute = attributes.get(attribute.get('id'))
+		value = global_attribute.terms.get(attribute['option'], attribute['option']) if global_attribute else attribute['option']
+		meta_data.append({'key': prefix + attribute_name(attribute, attributes), 'value': value})
+	return {'sku': product.get('sku'), 'name': product.get('name'), 'meta_data': meta_data}
+
+def attribute_name(attribute, attributes):
+	"The Item Attribute name of a product or variation attribute: the global taxonomy slug without pa_, or the custom name"
+	global_attribute = attributes.get(attribute.get('id'))
+	if global_attribute:
+		slug = global_attribute.slug
+		return slug[3:] if slug.startswith('pa_') else slug
+	return attribute.get('name')
+
+def make_template(product, attributes):
+	"""
+	Insert the Item template of a variable product with the variation attributes that exist as Item Attribute.
+	Returns None if it has none, the product is then skipped.
+	"""
+	from slife.slife.cache import get_default_warehouse, get_settings
+
+	settings = get_settings()
+	keys = [attribute_name(attribute, attributes) for attribute in product.get('attributes') or []
+		if attribute.get('variation')]
+	keys = [key for key in keys if key]
+	keys = frappe.get_all('Item Attribute', filters={'name': ('in', keys)}, pluck='name') if keys else []
+	if not keys:
+		return None
+
+	doc = frappe.new_doc('Item')
+	doc.item_code = product['sku']
+	doc.item_name = product.get('name')
+	doc.description = f"<div><p>{product.get('name')}</p></div>"
+	doc.item_group = settings.item_group
+	doc.stock_uom = settings.uom or "Nos"
+	doc.sales_uom = doc.stock_uom
+	doc.is_stock_item = False
+	doc.has_variants = True
+	doc.variant_based_on = 'Item Attribute'
+	doc.append("item_defaults", {
+		"company": settings.company,
+		"default_warehouse": settings.warehouse or get_default_warehouse(settings.company)
+	})
+	for key in sorted(keys):
+		doc.append('attributes', {'attribute': key})
+	doc.insert()
+	return doc
@@ -0,0 +1,120 @@
+# Copyright (c) 2022, Slife
+# For license information, please see license.txt
+
+"""
+Consolidated outsourcing. When Woocommerce Settings rfq_consolidation is set the RFQ stage of
+each order is skipped. Instead the scheduler collects the Sales Order items of recent outsourced
+orders that have no submitted Material Request item and creates one Material Request & draft RFQ
+per supplier. Each RFQ item records the rfq_number (Sales Order po_no) of the order it was requested for.
+Consolidation is tracked per Sales Order item, through the Material Request item sales_order_item,
+so an order whose items go to several suppliers stays outstanding until every supplier's RFQ is created.
+"""
+
+import frappe
+from frappe.utils import add_days, now_datetime, nowdate
+
+# Orders older than this are never consolidated, e.g. bulk imported or from before the setting was enabled
+WINDOW = 14 # days
+
+def consolidate_hourly():
+	"Scheduler: consolidate RFQs when Woocommerce Settings rfq_consolidation is Hourly"
+	from slife.slife.cache import get_settings
+	if get_settings().rfq_consolidation == 'Hourly':
+		consolidate()
+
+def consolidate_daily():
+	"Scheduler: consolidate RFQs when Woocommerce Settings rfq_consolidation is Daily"
+	from slife.slife.cache import get_settings
+	if get_settings().rfq_consolidation == 'Daily':
+		consolidate()
+
+def consolidate():
+	"Create one Material Request & RFQ per supplier for the outsourced orders without an RFQ"
+	from slife.slife.cache import get_settings
+
+	settings = get_settings()
+	if not settings.orders_outsourced:
+		return
+	orders = get_outstanding_orders(settings.company)
+	for supplier, items in group_by_supplier(orders, settings).items():
+		frappe.db.savepoint('slife_consolidation')
+		try:
+			create_consolidated_rfq(supplier, items, settings)
+		except Exception:
+			frappe.db.rollback(save_point='slife_consolidation')
+			frappe.log_error(frappe.get_traceback(), "WooCommerce RFQ Consolidation Error")
+		frappe.db.commit()
+
+def get_outstanding_orders(company):
+	"""
+	Submitted Sales Orders of the last WINDOW days whose stages are done, not On Hold or Closed,
+	with an item not fully requested by submitted Material Requests
+	"""
+	return frappe.db.sql("""select link.name as link, so.name as sales_order, so.po_no
+		from `tabWoocommerce Order Link` link
+		join `tabSales Order` so on so.name = link.sales_order
+		where link.stage_status = 'Completed' and so.docstatus = 1 and so.status not in ('On Hold', 'Closed')
+			and so.company = %(company)s and so.transaction_date >= %(since)s
+			and exists (select 1 from `tabSales Order Item` soi
+				where soi.parent = so.name and soi.stock_qty > (select ifnull(sum(mri.stock_qty), 0)
+					from `tabMaterial Request Item` mri where mri.sales_order_item = soi.name and mri.docstatus = 1))
+		order by so.creation""", {'company': company, 'since': add_days(nowdate(), -WINDOW)}, as_dict=True)
+
+def group_by_supplier(orders, settings):
+	"""
+	Material Request items of the orders by supplier: the Item Default supplier of the
+	company or the Woocommerce Settings supplier. Items already requested are left out by make_material_request.
+	"""
+	from erpnext.selling.doctype.sales_order.sales_order import make_material_request
+
+	items = []
+	for order in orders:
+		for item in make_material_request(order.sales_order).items:
+			item.rfq_number = order.po_no
+			item.link = order.link
+			items.append(item)
+	if not items:
+		return {}
+
+	suppliers = dict(frappe.get_all('Item Default',
+		filters={'parent': ('in', {item.item_code for item in items}), 'company': settings.company,
+			'default_supplier': ('is', 'set')},
+		fields=['parent', 'default_supplier'], as_list=True
+	))
+	by_supplier = {}
+	for item in items:
+		by_supplier.setdefault(suppliers.get(item.item_code) or settings.supplier, []).append(item)
+	return by_supplier
+
+def create_consolidated_rfq(supplier, items, settings):
+	"Create and submit the Material Request of the items, then a draft RFQ to the supplier"
+	from erpnext.stock.doctype.material_request.material_request import make_request_for_quotation
+	from slife.slife.doctype.woocommerce_order_link.woocommerce_order_link import update_order_link
+
+	mat_req = frappe.new_doc('Material Request')
+	mat_req.material_request_type = 'Purchase'
+	mat_req.company = settings.company
+	mat_req.transaction_date = nowdate()
+	mat_req.schedule_date = add_days(mat_req.transaction_date, settings.quote_after or 7)
+	rfq_numbers = {}
+	for item in items:
+		row = mat_req.append('items', item.as_dict(no_default_fields=True))
+		row.schedule_date = mat_req.schedule_date
+		rfq_numbers[row.sales_order_item] = item.rfq_number
+	mat_req.insert()
+	mat_req.submit()
+
+	rfq = make_request_for_quotation(mat_req.name)
+	rfq.append('suppliers', {'supplier': supplier})
+	rfq.rfq_number = f'{supplier}-{now_datetime():%Y%m%d%H%M}'
+	rfq.email_template = settings.rfq_email_template
+	mr_items = {row.name: row.sales_order_item for row in mat_req.items}
+	for row in rfq.items:
+		row.rfq_number = rfq_numbers.get(mr_items.get(row.material_request_item))
+	rfq.insert()
+
+	# The link keeps the first RFQ of the order, the items of each RFQ are found by sales_order_item
+	for link in {item.link for item in items}:
+		if not frappe.db.get_value('Woocommerce Order Link', link, 'request_for_quotation'):
+			update_order_link(frappe._dict(name=link), material_request=mat_req.name, request_for_quotation=rfq.name)
+	return rfq
@@ -0,0 +1,64 @@
+# Copyright (c) 2022, Richard Case and Contributors
+# See license.txt
+
+import json
+import unittest
+
+import frappe
+
+from slife.slife.doctype.woocommerce_dead_letter.woocommerce_dead_letter import dead_letter, partition, replay
+from slife.slife.locks import release_all
+
+class TestWoocommerceDeadLetter(unittest.TestCase):
+	"Keeping and replaying failed payloads. Nothing is committed"
+
+	def tearDown(self):
+		release_all()
+		frappe.db.rollback()
+
+	def letter(self, payload):
+		try:
+			raise frappe.ValidationError('Test failure')
+		except frappe.ValidationError as e:
+			return dead_letter(json.dumps(payload), e, 'get_items')
+
+	def test_dead_letter(self):
+		wc_order_id = frappe.generate_hash(length=10)
+		letter = self.letter({'id': wc_order_id, 'status': 'pending'})
+		self.assertEqual(letter.status, 'Open')
+		self.assertEqual(letter.error_class, 'ValidationError')
+		self.assertEqual(letter.stage, 'get_items')
+		self.assertEqual(letter.wc_order_id, wc_order_id)
+		self.assertEqual(letter.event, 'created')
+		self.assertIn('Test failure', letter.error)
+
+	def test_replay(self):
+		# Not JSON, fails again
+		letter = self.letter({})
+		letter.db_set('payload', 'webhook_id=1')
+		self.assertFalse(replay(letter.name))
+		letter.reload()
+		self.assertEqual(letter.status, 'Open')
+		self.assertEqual(letter.attempts, 2)
+		self.assertEqual(letter.error_class, 'JSONDecodeError')
+		# Events without a handler succeed
+		letter.db_set({'payload': '{}', 'resource': 'coupon'})
+		self.assertTrue(replay(letter.name))
+		self.assertEqual(frappe.db.get_value('Woocommerce Dead Letter', letter.name, 'status'), 'Replayed')
+
+	def test_replay_permission(self):
+		from slife.slife.doctype.woocommerce_dead_letter.woocommerce_dead_letter import replay_selected
+		frappe.set_user('Guest')
+		try:
+			self.assertRaises(frappe.PermissionError, replay_selected)
+		finally:
+			frappe.set_user('Administrator')
+
+	def test_partition(self):
+		letters = [frappe._dict(name=f'letter{i}', wc_order_id=str(i % 3)) for i in range(9)]
+		parts = partition(letters, 4)
+		self.assertEqual(sorted(name for part in parts for name in part), sorted(letter.name for letter in letters))
+		for part in parts:
+			# The letters of an order are kept together, in order
+			orders = {letter.wc_order_id for letter in letters if letter.name in part}
+			self.assertEqual(part, [letter.name for letter in letters if letter.wc_order_id in orders])
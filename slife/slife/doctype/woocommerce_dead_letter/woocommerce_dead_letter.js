@@ -0,0 +1,15 @@
+// Copyright (c) 2022, Richard Case and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on('Woocommerce Dead Letter', {
+	refresh: function(frm) {
+		if (frm.doc.status === 'Open') {
+			frm.add_custom_button(__('Replay'), function() {
+				frappe.call('slife.slife.doctype.woocommerce_dead_letter.woocommerce_dead_letter.replay_selected',
+					{names: [frm.doc.name]}).then(() => {
+					frappe.show_alert(__('Queued for replay'));
+				});
+			});
+		}
+	}
+});
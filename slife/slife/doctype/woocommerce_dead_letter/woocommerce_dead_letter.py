@@ -0,0 +1,204 @@
+# Copyright (c) 2022, Richard Case and contributors
+# For license information, please see license.txt
+
+"""
+Payloads that failed in the order pipeline, with the error class, the failing stage and the webhook headers.
+Open letters are replayed through _order from the list view or with `bench --site <site> slife-replay-dead-letters`,
+by parallel workers retrying with exponential backoff so transient failures (e.g. a DB restart) clear in one run.
+"""
+
+import time
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import cint, now_datetime
+
+# Replay rounds of a letter, the wait before a round is doubled each time
+MAX_ATTEMPTS = 5
+BACKOFF = 2 # seconds
+# Letters per background job of the list view replay action
+REPLAY_BATCH = 50
+
+class WoocommerceDeadLetter(Document):
+	pass
+
+def dead_letter(payload, error, stage=None, inbox=None):
+	"""
+	Keep a payload that failed with the error exception, or count another failed attempt of its letter.
+	inbox is the Woocommerce Inbox doc of a webhook, its headers are copied. Call after rolling back the order
+	"""
+	letter = None
+	if inbox:
+		name = frappe.db.get_value('Woocommerce Dead Letter', {'inbox': inbox.name})
+		letter = frappe.get_doc('Woocommerce Dead Letter', name) if name else None
+	if letter is None:
+		letter = frappe.get_doc({
+			'doctype': 'Woocommerce Dead Letter',
+			'payload': payload,
+			'attempts': 0
+		})
+		if inbox:
+			letter.update({
+				'inbox': inbox.name,
+				'wc_order_id': inbox.wc_order_id,
+				'event': inbox.event,
+				'resource': inbox.resource,
+				'delivery_id': inbox.delivery_id,
+				'webhook_id': inbox.webhook_id,
+				'signature': inbox.signature,
+				'source': inbox.source
+			})
+		else:
+			set_order(letter)
+
+	letter.update({
+		'status': 'Open',
+		'error_class': type(error).__name__,
+		'stage': stage,
+		'error': frappe.get_traceback(),
+		'attempts': cint(letter.attempts) + 1,
+		'last_attempt': now_datetime()
+	})
+	letter.save(ignore_permissions=True)
+	return letter
+
+def set_order(letter):
+	"Set the Woocommerce order id of a letter without an inbox, e.g. from a bulk import"
+	import json
+	try:
+		letter.wc_order_id = json.loads(letter.payload).get('id')
+	except (ValueError, AttributeError):
+		pass
+	letter.event = letter.event or 'created'
+	letter.resource = letter.resource or 'order'
+
+def replay(name):
+	"""
+	Run an Open letter through _order again in its own savepoint. Returns True once replayed.
+	The caller commits and releases the locks, see replay_letters
+	"""
+	from slife.slife import timing
+	from slife.slife.doctype.woocommerce_inbox.woocommerce_inbox import set_status
+	from slife.slife.locks import acquire, order_lock_keys
+	from slife.slife.woocommerce import _order
+
+	letter = frappe.get_doc('Woocommerce Dead Letter', name)
+	if letter.status != 'Open':
+		return True
+
+	frappe.db.savepoint('slife_replay')
+	timing.start()
+	try:
+		if not acquire(order_lock_keys(letter.payload)):
+			raise frappe.QueryTimeoutError('Timed out waiting for the customer lock of the order')
+		_order(letter.payload, letter.event, letter.delivery_id, letter.inbox, letter.resource)
+	except Exception as e:
+		frappe.db.rollback(save_point='slife_replay')
+		letter.update({
+			'error_class': type(e).__name__,
+			'stage': timing.failed_stage(),
+			'error': frappe.get_traceback(),
+			'attempts': cint(letter.attempts) + 1,
+			'last_attempt': now_datetime()
+		})
+		letter.save(ignore_permissions=True)
+		return False
+
+	letter.update({'status': 'Replayed', 'last_attempt': now_datetime()})
+	letter.save(ignore_permissions=True)
+	if letter.inbox:
+		set_status(letter.inbox, 'Processed')
+	return True
+
+def replay_letters(names, attempts=MAX_ATTEMPTS, backoff=BACKOFF):
+	"""
+	Replay the letters in order, committing each. Failed letters are retried in later rounds, waiting
+	backoff seconds before the second round and doubling the wait each round. Returns replayed & failed counts
+	"""
+	from slife.slife.locks import release_all
+
+	frappe.set_user(frappe.db.get_single_value('Woocommerce Settings', 'creation_user') or 'Administrator')
+	pending = list(names)
+	replayed = 0
+	for attempt in range(attempts):
+		if attempt:
+			time.sleep(backoff * 2 ** (attempt - 1))
+		failed = []
+		for name in pending:
+			try:
+				if replay(name):
+					replayed += 1
+				else:
+					failed.append(name)
+				frappe.db.commit()
+			finally:
+				release_all()
+		pending = failed
+		if not pending:
+			break
+	return {'replayed': replayed, 'failed': len(pending)}
+
+def get_open_letters(names=None):
+	"The Open letter names, all or among names, with the events of an order in the order received"
+	filters = {'status': 'Open'}
+	if names:
+		filters['name'] = ('in', names)
+	return frappe.get_all('Woocommerce Dead Letter', filters=filters, fields=['name', 'wc_order_id'],
+		order_by='creation asc')
+
+def partition(letters, partitions):
+	"Split the letters into partitions, keeping the letters of an order together and in order"
+	import zlib
+	parts = [[] for i in range(partitions)]
+	for letter in letters:
+		key = letter.wc_order_id or letter.name
+		parts[zlib.crc32(key.encode('utf8')) % partitions].append(letter.name)
+	return [part for part in parts if part]
+
+@frappe.whitelist()
+def replay_selected(names=None):
+	"List view action: queue the selected Open letters, or all, for replay by background workers in parallel"
+	import json
+	frappe.has_permission('Woocommerce Dead Letter', 'write', throw=True)
+	if isinstance(names, str):
+		names = json.loads(names)
+	if names is not None and not names:
+		return 0
+	letters = get_open_letters(names)
+	for part in partition(letters, max(1, -(-len(letters) // REPLAY_BATCH))):
+		frappe.enqueue('slife.slife.doctype.woocommerce_dead_letter.woocommerce_dead_letter.replay_letters',
+			queue='long', timeout=3600, names=part)
+	return len(letters)
+
+def replay_site(site, names=None, workers=4, attempts=MAX_ATTEMPTS, backoff=BACKOFF):
+	"Replay the Open letters, all or among names, with a pool of worker processes. Returns totals and letters/second"
+	from multiprocessing import Pool
+
+	start = time.monotonic()
+	frappe.init(site=site)
+	frappe.connect()
+	try:
+		parts = partition(get_open_letters(names), workers)
+	finally:
+		frappe.destroy()
+
+	args = [(site, part, attempts, backoff) for part in parts]
+	if len(args) > 1:
+		with Pool(len(args)) as pool:
+			results = pool.starmap(replay_partition, args)
+	else:
+		results = [replay_partition(*a) for a in args]
+
+	result = {key: sum(r[key] for r in results) for key in ('replayed', 'failed')}
+	result['seconds'] = time.monotonic() - start
+	result['rate'] = result['replayed'] / result['seconds'] if result['seconds'] else 0
+	return result
+
+def replay_partition(site, names, attempts, backoff):
+	"Worker process: replay the letters of one partition"
+	frappe.init(site=site)
+	frappe.connect()
+	try:
+		return replay_letters(names, attempts, backoff)
+	finally:
+		frappe.destroy()
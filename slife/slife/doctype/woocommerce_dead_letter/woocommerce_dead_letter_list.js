@@ -0,0 +1,29 @@
+// Copyright (c) 2022, Richard Case and contributors
+// For license information, please see license.txt
+
+frappe.listview_settings['Woocommerce Dead Letter'] = {
+	get_indicator: function(doc) {
+		const colors = {
+			'Open': 'red',
+			'Replayed': 'green'
+		};
+		return [__(doc.status), colors[doc.status], 'status,=,' + doc.status];
+	},
+	onload: function(listview) {
+		const replay = function(names) {
+			frappe.call('slife.slife.doctype.woocommerce_dead_letter.woocommerce_dead_letter.replay_selected',
+				{names: names}).then(r => {
+				frappe.show_alert(__('{0} letters queued for replay', [r.message]));
+			});
+		};
+		listview.page.add_actions_menu_item(__('Replay'), function() {
+			const names = listview.get_checked_items(true);
+			if (names.length) {
+				replay(names);
+			}
+		});
+		listview.page.add_inner_button(__('Replay All'), function() {
+			frappe.confirm(__('Replay every Open letter?'), () => replay(null));
+		});
+	}
+};
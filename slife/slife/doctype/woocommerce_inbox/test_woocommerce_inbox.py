@@ -0,0 +1,61 @@
+# Copyright (c) 2022, Richard Case and Contributors
+# See license.txt
+
+import json
+import unittest
+
+import frappe
+
+from slife.slife.doctype.woocommerce_inbox.woocommerce_inbox import coalesce, set_order
+
+class TestWoocommerceInbox(unittest.TestCase):
+	"Priorities and coalescing. Nothing is committed so workers never see the entries"
+
+	def tearDown(self):
+		frappe.db.rollback()
+
+	def entry(self, wc_order_id, status, date_modified):
+		doc = frappe.get_doc({
+			'doctype': 'Woocommerce Inbox',
+			'resource': 'order',
+			'event': 'updated',
+			'payload': json.dumps({'id': wc_order_id, 'status': status, 'date_modified': date_modified})
+		})
+		set_order(doc)
+		doc.insert(ignore_permissions=True)
+		return doc
+
+	def test_priority(self):
+		wc_order_id = frappe.generate_hash(length=10)
+		priorities = [self.entry(wc_order_id, status, '2022-03-28T10:00:00').priority
+			for status in ('processing', 'on-hold', 'pending', 'failed')]
+		self.assertEqual(priorities, sorted(priorities))
+		self.assertLess(priorities[0], priorities[1])
+		self.assertLess(priorities[1], priorities[2])
+
+	def test_coalesce(self):
+		wc_order_id = frappe.generate_hash(length=10)
+		created = self.entry(wc_order_id, 'pending', '2022-03-28T10:00:00')
+		latest = self.entry(wc_order_id, 'processing', '2022-03-28T10:00:05')
+		# Delivered out of order
+		updated = self.entry(wc_order_id, 'pending', '2022-03-28T10:00:02')
+		self.assertEqual(coalesce(wc_order_id), latest.name)
+		for doc in (created, updated):
+			self.assertEqual(frappe.db.get_value('Woocommerce Inbox', doc.name, 'status'), 'Superseded')
+		self.assertEqual(frappe.db.get_value('Woocommerce Inbox', latest.name, 'status'), 'Queued')
+
+	def test_coalesce_keeps_creating_event(self):
+		wc_order_id = frappe.generate_hash(length=10)
+		created = self.entry(wc_order_id, 'processing', '2022-03-28T10:00:00')
+		cancelled = self.entry(wc_order_id, 'cancelled', '2022-03-28T10:00:05')
+		# Without a link the cancelled update can't create the order, the created event runs first
+		self.assertEqual(coalesce(wc_order_id), created.name)
+		self.assertEqual(frappe.db.get_value('Woocommerce Inbox', cancelled.name, 'status'), 'Queued')
+
+	def test_coalesce_completed(self):
+		"A paid order completed seconds after it was created, the completed update creates it"
+		wc_order_id = frappe.generate_hash(length=10)
+		created = self.entry(wc_order_id, 'processing', '2022-03-28T10:00:00')
+		completed = self.entry(wc_order_id, 'completed', '2022-03-28T10:00:03')
+		self.assertEqual(coalesce(wc_order_id), completed.name)
+		self.assertEqual(frappe.db.get_value('Woocommerce Inbox', created.name, 'status'), 'Superseded')
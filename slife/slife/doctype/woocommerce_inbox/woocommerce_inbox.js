@@ -0,0 +1,8 @@
+// Copyright (c) 2022, Richard Case and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on('Woocommerce Inbox', {
+	// refresh: function(frm) {
+
+	// }
+});
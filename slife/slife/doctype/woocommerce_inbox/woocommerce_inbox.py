@@ -0,0 +1,265 @@
+# Copyright (c) 2022, Richard Case and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import add_days, add_to_date, now_datetime, nowdate
+
+# Entries stuck in Processing longer than this were abandoned by a dead worker
+PROCESSING_TIMEOUT = 30 # minutes
+# Queued entries are processed by priority, lowest first, then oldest first. Paid orders are never rate limited
+PRIORITIES = {'processing': 1, 'completed': 1, 'on-hold': 2}
+PAID_PRIORITY = 1
+DEFAULT_PRIORITY = 3
+# Days Processed & Superseded entries are kept by clear_old_entries, their orders are archived, see Woocommerce Order Archive.
+# Failed entries are kept, see Woocommerce Dead Letter
+KEEP_DAYS = 7
+# Doctypes whose inbox Link is cleared when the entry is deleted, so it does not block the delete
+INBOX_LINKS = ('Woocommerce Order Link', 'Woocommerce Dead Letter')
+
+class WoocommerceInbox(Document):
+	def on_trash(self):
+		for doctype in INBOX_LINKS:
+			frappe.db.set_value(doctype, {'inbox': self.name}, 'inbox', None, update_modified=False)
+
+def on_doctype_update():
+	frappe.db.add_index('Woocommerce Inbox', ['status', 'priority', 'creation'])
+
+def enqueue_request(verify_time=None):
+	"Store the verified webhook request in the inbox and queue it for a background worker"
+	doc = frappe.get_doc({
+		'doctype': 'Woocommerce Inbox',
+		'event': frappe.get_request_header("x-wc-webhook-event"),
+		'resource': frappe.get_request_header("x-wc-webhook-resource"),
+		'delivery_id': frappe.get_request_header("x-wc-webhook-delivery-id"),
+		'webhook_id': frappe.get_request_header("x-wc-webhook-id"),
+		'signature': frappe.get_request_header("x-wc-webhook-signature"),
+		'source': frappe.get_request_header("x-wc-webhook-source"),
+		'payload': frappe.request.data.decode('utf8'),
+		'verify_time': verify_time
+	})
+	set_order(doc)
+	doc.insert(ignore_permissions=True)
+	enqueue(doc.name)
+	return doc.name
+
+def enqueue(inbox):
+	"Queue an inbox entry. The job only runs once the entry has been committed"
+	frappe.enqueue('slife.slife.doctype.woocommerce_inbox.woocommerce_inbox.process',
+		queue='default', job_name=inbox, enqueue_after_commit=True, inbox=inbox)
+
+def set_order(doc):
+	"Set the Woocommerce order id, status, date_modified and priority of an order event from its payload"
+	import json
+
+	if (doc.resource or 'order') != 'order':
+		return
+	order = json.loads(doc.payload)
+	doc.wc_order_id = order.get('id')
+	doc.order_status = order.get('status')
+	doc.date_modified = order.get('date_modified')
+	doc.priority = PRIORITIES.get(doc.order_status, DEFAULT_PRIORITY)
+
+def claim(batch_size=1):
+	"""
+	Atomically move Queued entries to Processing so only one worker handles each, up to batch_size for group commits.
+	Entries are taken by priority, see PRIORITIES, and the queued events of a Woocommerce order are coalesced:
+	only the latest is processed, the others are Superseded.
+	"""
+	filters = {'status': 'Queued'}
+	if rate_limited():
+		# Deferred entries are queued again by requeue
+		filters['priority'] = ('<=', PAID_PRIORITY)
+	candidates = frappe.get_all('Woocommerce Inbox', filters=filters,
+		fields=['name', 'wc_order_id'], order_by='priority asc, creation asc', limit=batch_size)
+
+	claimed = []
+	for entry in candidates:
+		name = coalesce(entry.wc_order_id) if entry.wc_order_id else entry.name
+		frappe.db.sql("""update `tabWoocommerce Inbox`
+			set status='Processing', started=%s, attempts=attempts+1
+			where name=%s and status='Queued'""", (now_datetime(), name))
+		if frappe.db._cursor.rowcount > 0:
+			claimed.append(name)
+	if claimed:
+		count_rate(frappe.get_all('Woocommerce Inbox',
+			filters={'name': ('in', claimed), 'priority': ('>', PAID_PRIORITY)}, pluck='name'))
+	frappe.db.commit()
+	return claimed
+
+def coalesce(wc_order_id):
+	"""
+	Supersede all but the latest queued event of a Woocommerce order. Returns the latest.
+	Until the order has a link, an event whose status can't create the order (e.g. cancelled) never supersedes
+	one that can: the latest creating event is returned and the later events stay queued
+	"""
+	from slife.slife.woocommerce import NEW_ORDER_STATUSES
+
+	entries = frappe.get_all('Woocommerce Inbox',
+		filters={'status': 'Queued', 'wc_order_id': wc_order_id},
+		fields=['name', 'order_status'], order_by='date_modified desc, creation desc')
+	if not entries:
+		return None
+	latest = 0
+	if (entries[0].order_status not in NEW_ORDER_STATUSES
+		and not frappe.db.exists('Woocommerce Order Link', {'wc_order_id': wc_order_id})):
+		latest = next((i for i, entry in enumerate(entries) if entry.order_status in NEW_ORDER_STATUSES), 0)
+	superseded = tuple(entry.name for entry in entries[latest + 1:])
+	if superseded:
+		frappe.db.sql("""update `tabWoocommerce Inbox`
+			set status='Superseded', finished=%s
+			where name in %s and status='Queued'""", (now_datetime(), superseded))
+	return entries[latest].name
+
+def rate_limited():
+	"Whether Woocommerce Settings unpaid_orders_per_minute have been processed this minute"
+	from frappe.utils import cint
+	from slife.slife.cache import get_settings
+
+	limit = cint(get_settings().unpaid_orders_per_minute)
+	return limit and cint(frappe.cache().get(_rate_key())) >= limit
+
+def count_rate(names):
+	if names:
+		key = _rate_key()
+		frappe.cache().incrby(key, len(names))
+		frappe.cache().expire(key, 120)
+
+def _rate_key():
+	return frappe.cache().make_key(f"slife_inbox_rate:{now_datetime():%Y%m%d%H%M}")
+
+def process(inbox=None):
+	"""
+	Background job: run queued webhooks through the order pipeline. There is a job per entry, the job processes the
+	highest priority entries rather than its own entry, see claim. Each order runs in its own savepoint and the batch is committed once, see Woocommerce Settings orders_per_commit.
+	The customer locks of the orders are held until the commit, see locks
+	"""
+	import time
+	from frappe.utils import cint
+	from slife.slife import timing
+	from slife.slife.cache import get_settings
+	from slife.slife.doctype.woocommerce_dead_letter.woocommerce_dead_letter import dead_letter
+	from slife.slife.locks import acquire, order_lock_keys, release_all
+	from slife.slife.warmup import warm_up
+	from slife.slife.woocommerce import _order
+
+	# Only the first order of a new worker includes the warm-up
+	warm_up_time = warm_up()
+	# Already processed or taken by another worker if nothing is claimed
+	docs = [frappe.get_doc('Woocommerce Inbox', name) for name in claim(cint(get_settings().orders_per_commit) or 1)]
+	keys = []
+	for doc in docs:
+		try:
+			keys += order_lock_keys(doc.payload)
+		except ValueError:
+			# Not JSON, fails in _order
+			pass
+	# The locks of the whole batch are taken at once, in sorted order, so two batches can't deadlock
+	start = time.perf_counter()
+	try:
+		acquired = acquire(keys)
+	except Exception:
+		frappe.db.rollback()
+		frappe.log_error(frappe.get_traceback(), "WooCommerce Lock Error")
+		acquired = False
+	if not acquired:
+		# Another worker holds a customer for too long, try again later
+		release_all()
+		requeue_batch(docs)
+		return
+	lock_time = (time.perf_counter() - start) * 1000
+	# Start a new transaction so the orders read what the previous lock holders committed
+	frappe.db.commit()
+
+	try:
+		for doc in docs:
+			frappe.db.savepoint('slife_order')
+			timing.start(warm_up=warm_up_time, verify_request=doc.verify_time, acquire_locks=lock_time)
+			# Recorded against the first order of the batch, as the warm-up
+			warm_up_time = lock_time = None
+			try:
+				_order(doc.payload, doc.event, doc.delivery_id, doc.name, doc.resource)
+			except Exception as e:
+				try:
+					frappe.db.rollback(save_point='slife_order')
+				except Exception:
+					# A deadlock or a lost connection rolled back the whole transaction, savepoints included,
+					# with the orders of the batch already processed. Run the batch again
+					frappe.db.rollback()
+					frappe.log_error(f"{frappe.get_traceback()}\n\n Request Data: \n{doc.payload}", "WooCommerce Batch Error")
+					requeue_batch(docs)
+					return
+				set_status(doc.name, 'Failed', frappe.get_traceback())
+				# Kept for replay, see Woocommerce Dead Letter. Never lose the rest of the batch over it
+				frappe.db.savepoint('slife_dead_letter')
+				try:
+					dead_letter(doc.payload, e, timing.failed_stage(), doc)
+				except Exception:
+					frappe.db.rollback(save_point='slife_dead_letter')
+					frappe.log_error(f"{frappe.get_traceback()}\n\n Request Data: \n{doc.payload}", "WooCommerce Dead Letter Error")
+			else:
+				set_status(doc.name, 'Processed')
+		frappe.db.commit()
+	finally:
+		release_all()
+
+def requeue_batch(docs):
+	"Queue the claimed entries again and commit"
+	for doc in docs:
+		frappe.db.set_value('Woocommerce Inbox', doc.name, 'status', 'Queued', update_modified=False)
+		enqueue(doc.name)
+	frappe.db.commit()
+
+def set_status(inbox, status, error=None):
+	frappe.db.set_value('Woocommerce Inbox', inbox, {
+		'status': status,
+		'finished': now_datetime(),
+		'error': error
+	}, update_modified=False)
+
+def requeue():
+	"Scheduler: queue entries again whose job was lost, e.g. after a worker or Redis restart"
+	from frappe.utils.background_jobs import get_jobs
+
+	now = now_datetime()
+	frappe.db.sql("""update `tabWoocommerce Inbox` set status='Queued'
+		where status='Processing' and started < %s""", add_to_date(now, minutes=-PROCESSING_TIMEOUT))
+
+	queued = get_jobs(site=frappe.local.site, key='job_name')[frappe.local.site]
+	for name in frappe.get_all('Woocommerce Inbox',
+		filters={'status': 'Queued', 'creation': ('<', add_to_date(now, minutes=-5))},
+		pluck='name', order_by='creation asc'
+	):
+		if name not in queued:
+			enqueue(name)
+	frappe.db.commit()
+
+def clear_old_entries():
+	"""
+	Scheduler: delete Processed & Superseded entries, with their raw payloads, finished more than KEEP_DAYS ago.
+	Deleted in bulk, clearing the INBOX_LINKS like on_trash does
+	"""
+	conditions = "status in ('Processed', 'Superseded') and finished < %s"
+	before = add_days(nowdate(), -KEEP_DAYS)
+	for doctype in INBOX_LINKS:
+		frappe.db.sql(f"""update `tab{doctype}` set inbox = null
+			where inbox in (select name from `tabWoocommerce Inbox` where {conditions})""", before)
+	frappe.db.sql(f"delete from `tabWoocommerce Inbox` where {conditions}", before)
+	frappe.db.commit()
+
+@frappe.whitelist()
+def get_stats():
+	"Queue depth, age of the oldest queued entry in seconds, entries processed & superseded in the last hour"
+	frappe.has_permission('Woocommerce Inbox', 'read', throw=True)
+	now = now_datetime()
+	oldest = frappe.db.get_value('Woocommerce Inbox', {'status': 'Queued'}, 'min(creation)')
+	return {
+		'depth': frappe.db.count('Woocommerce Inbox', {'status': ('in', ('Queued', 'Processing'))}),
+		'age': (now - oldest).total_seconds() if oldest else 0,
+		'throughput': frappe.db.count('Woocommerce Inbox',
+			{'status': 'Processed', 'finished': ('>', add_to_date(now, hours=-1))}),
+		'failed': frappe.db.count('Woocommerce Inbox', {'status': 'Failed'}),
+		'superseded': frappe.db.count('Woocommerce Inbox',
+			{'status': 'Superseded', 'finished': ('>', add_to_date(now, hours=-1))}),
+		'rate_limited': bool(rate_limited())
+	}
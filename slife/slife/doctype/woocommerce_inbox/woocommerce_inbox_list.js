@@ -0,0 +1,30 @@
+// Copyright (c) 2022, Richard Case and contributors
+// For license information, please see license.txt
+
+frappe.listview_settings['Woocommerce Inbox'] = {
+	get_indicator: function(doc) {
+		const colors = {
+			'Queued': 'orange',
+			'Processing': 'blue',
+			'Processed': 'green',
+			'Failed': 'red',
+			'Superseded': 'gray'
+		};
+		return [__(doc.status), colors[doc.status], 'status,=,' + doc.status];
+	},
+	onload: function(listview) {
+		listview.page.add_inner_button(__('Queue Stats'), function() {
+			frappe.call('slife.slife.doctype.woocommerce_inbox.woocommerce_inbox.get_stats').then(r => {
+				const stats = r.message;
+				frappe.msgprint(`
+					${__('Depth')}: ${stats.depth}<br>
+					${__('Oldest queued')}: ${Math.round(stats.age)}s<br>
+					${__('Processed in the last hour')}: ${stats.throughput}<br>
+					${__('Superseded in the last hour')}: ${stats.superseded}<br>
+					${__('Failed')}: ${stats.failed}<br>
+					${__('Unpaid orders rate limited')}: ${stats.rate_limited ? __('Yes') : __('No')}
+				`, __('Woocommerce Inbox'));
+			});
+		});
+	}
+};
@@ -0,0 +1,37 @@
+# Copyright (c) 2022, Richard Case and contributors
+# For license information, please see license.txt
+
+import base64
+import zlib
+
+import frappe
+from frappe.model.document import Document
+
+class WoocommerceOrderArchive(Document):
+	pass
+
+def archive_order(sales_order, payload, order_key=None):
+	"Store the compressed Woocommerce order JSON of a Sales Order"
+	data = payload.encode('utf8')
+	doc = frappe.get_doc({
+		'doctype': 'Woocommerce Order Archive',
+		'sales_order': sales_order,
+		'order_key': order_key,
+		'compression': 'zlib',
+		'size': len(data),
+		'payload': base64.b64encode(zlib.compress(data, 9)).decode('ascii')
+	})
+	doc.insert(ignore_permissions=True)
+	return doc
+
+def delete_archive(doc, method=None):
+	"Sales Order on_trash: delete its archive, which would block the delete"
+	frappe.db.delete('Woocommerce Order Archive', {'sales_order': doc.name})
+
+@frappe.whitelist()
+def get_order_json(sales_order):
+	"The Woocommerce order JSON of a Sales Order, loaded on demand"
+	frappe.has_permission('Sales Order', 'read', sales_order, throw=True)
+	payload = frappe.db.get_value('Woocommerce Order Archive', sales_order, 'payload')
+	if payload:
+		return zlib.decompress(base64.b64decode(payload)).decode('utf8')
@@ -0,0 +1,175 @@
+# Copyright (c) 2022, Richard Case and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import add_to_date, cint, now_datetime
+
+# Downstream documents of a submitted order, each created by its own job.
+# link field holding the document: (stage method, whether Woocommerce Settings enable the stage)
+# The link field is the idempotency key, a stage is skipped once it is set.
+STAGES = {
+	'sales_invoice': ('slife.slife.woocommerce.invoice_stage', lambda settings: True),
+	# Consolidated RFQs are created by the scheduler, see slife.slife.consolidation
+	'request_for_quotation': ('slife.slife.woocommerce.rfq_stage',
+		lambda settings: settings.orders_outsourced and not settings.rfq_consolidation)
+}
+MAX_ATTEMPTS = 5
+# Link fields of the documents of an order, cleared when the document is deleted, see unlink_document
+DOCUMENT_FIELDS = {
+	'Sales Order': 'sales_order',
+	'Sales Invoice': 'sales_invoice',
+	'Material Request': 'material_request',
+	'Request for Quotation': 'request_for_quotation'
+}
+# Minutes before a stage is queued again, doubled after each failed attempt. Also recovers lost jobs
+RETRY_AFTER = 5
+
+class WoocommerceOrderLink(Document):
+	pass
+
+def claim_order(order, delivery_id=None, inbox=None):
+	"""
+	Get or create the link for a Woocommerce order, named by its order_key.
+	Returns None if the order already has a Sales Order, i.e. a duplicate or retried delivery.
+	"""
+	order_key = order.get('order_key')
+	link = frappe.db.get_value('Woocommerce Order Link', order_key, ['name', 'sales_order'], as_dict=True)
+	if link:
+		if link.sales_order:
+			return None
+		# A previous attempt failed before the Sales Order was created
+		return frappe.get_doc('Woocommerce Order Link', link.name)
+
+	doc = frappe.get_doc({
+		'doctype': 'Woocommerce Order Link',
+		'order_key': order_key,
+		'wc_order_id': order.get('id'),
+		'delivery_id': delivery_id,
+		'inbox': inbox
+	})
+	try:
+		doc.insert(ignore_permissions=True)
+	except frappe.DuplicateEntryError:
+		# Inserted by a concurrent worker
+		return None
+	return doc
+
+def unlink_document(doc, method=None):
+	"""
+	on_trash of the documents in DOCUMENT_FIELDS: clear the deleted document from its link, which would block the delete.
+	An order whose Sales Order was deleted is created again by its next webhook, see order_updated
+	"""
+	field = DOCUMENT_FIELDS[doc.doctype]
+	frappe.db.set_value('Woocommerce Order Link', {field: doc.name}, field, None, update_modified=False)
+
+def get_order_link(order_key, for_update=False):
+	"""
+	Get the link for a Woocommerce order_key or None. for_update locks the link row until the commit,
+	and reads it with the locking read so it includes what was committed after the transaction's snapshot
+	"""
+	if for_update:
+		values = frappe.db.get_value('Woocommerce Order Link', order_key, '*', as_dict=True, for_update=True)
+		return frappe.get_doc(dict(values, doctype='Woocommerce Order Link')) if values else None
+	name = frappe.db.get_value('Woocommerce Order Link', order_key)
+	return frappe.get_doc('Woocommerce Order Link', name) if name else None
+
+def update_order_link(link, **documents):
+	"Record the names of documents created for the order, e.g. sales_order=..."
+	link.update(documents)
+	frappe.db.set_value('Woocommerce Order Link', link.name, documents, update_modified=False)
+
+def get_stages():
+	"The link fields of the stages enabled in Woocommerce Settings"
+	from slife.slife.cache import get_settings
+	settings = get_settings()
+	return [field for field, (method, enabled) in STAGES.items() if enabled(settings)]
+
+def queue_stages(link):
+	"Queue the stages of a submitted order. The jobs only run once the order has been committed"
+	update_order_link(link, stage_status='Queued', retry_after=add_to_date(now_datetime(), minutes=RETRY_AFTER))
+	for field in get_stages():
+		enqueue_stage(link.name, field)
+
+def enqueue_stage(order_key, field):
+	frappe.enqueue('slife.slife.doctype.woocommerce_order_link.woocommerce_order_link.run_stage',
+		queue='default', job_name=f'{order_key}:{field}', enqueue_after_commit=True, order_key=order_key, field=field)
+
+def run_stage(order_key, field):
+	"""
+	Background job: create the document of a stage unless the link already has it.
+	The stage is timed in its own Woocommerce Order Timing of the order_key
+	"""
+	from slife.slife import timing
+	from slife.slife.warmup import warm_up
+	warm_up_time = warm_up()
+
+	# Locks the link, the stages of an order run one at a time
+	link = get_order_link(order_key, for_update=True)
+	if not link:
+		# The order was rolled back
+		return
+	if link.stage_status != 'Queued':
+		return
+
+	timing.start(warm_up=warm_up_time)
+	if not link.get(field):
+		# Else queued again by retry_stages to apply the status
+		frappe.db.savepoint('slife_stage')
+		try:
+			frappe.get_attr(STAGES[field][0])(link)
+		except Exception:
+			frappe.db.rollback(save_point='slife_stage')
+			error = frappe.get_traceback()
+			frappe.log_error(error, f"WooCommerce {link.meta.get_label(field)} Error")
+			attempts = cint(link.get(f'{field}_attempts')) + 1
+			update_order_link(link, **{
+				f'{field}_attempts': attempts,
+				'stage_error': error,
+				'retry_after': add_to_date(now_datetime(), minutes=RETRY_AFTER * 2 ** attempts)
+			})
+	complete_stages(link)
+	timing.record(order_key, link.sales_order, job=field)
+	frappe.db.commit()
+
+def complete_stages(link):
+	"""
+	Once every stage has its document or used all its attempts apply the Woocommerce status.
+	The Sales Order is only put On Hold or Closed afterwards, it blocks creating the Sales Invoice & Material Request.
+	"""
+	from slife.slife.woocommerce import apply_status
+
+	missing = [field for field in get_stages() if not link.get(field)]
+	if any(cint(link.get(f'{field}_attempts')) < MAX_ATTEMPTS for field in missing):
+		return
+
+	frappe.db.savepoint('slife_status')
+	try:
+		apply_status(link, frappe.get_doc('Sales Order', link.sales_order))
+	except Exception:
+		frappe.db.rollback(save_point='slife_status')
+		error = frappe.get_traceback()
+		frappe.log_error(error, "WooCommerce Order Status Error")
+		attempts = cint(link.status_attempts) + 1
+		update_order_link(link, status_attempts=attempts, stage_error=error,
+			retry_after=add_to_date(now_datetime(), minutes=RETRY_AFTER * 2 ** attempts))
+		if attempts < MAX_ATTEMPTS:
+			# Retried by retry_stages
+			return
+		missing.append('status')
+	update_order_link(link, stage_status='Failed' if missing else 'Completed', retry_after=None)
+
+def retry_stages():
+	"Scheduler: queue the stages again that failed or whose job was lost"
+	for link in frappe.get_all('Woocommerce Order Link',
+		filters={'stage_status': 'Queued', 'retry_after': ('<', now_datetime())},
+		fields=['name'] + list(STAGES) + [f'{field}_attempts' for field in STAGES]
+	):
+		frappe.db.set_value('Woocommerce Order Link', link.name, 'retry_after',
+			add_to_date(now_datetime(), minutes=RETRY_AFTER), update_modified=False)
+		fields = [field for field in get_stages()
+			if not link.get(field) and cint(link.get(f'{field}_attempts')) < MAX_ATTEMPTS]
+		# Every stage is done or gave up, the status failed to apply: a stage job applies it again
+		for field in fields or get_stages()[:1]:
+			enqueue_stage(link.name, field)
+	frappe.db.commit()
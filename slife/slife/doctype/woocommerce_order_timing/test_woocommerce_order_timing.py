@@ -0,0 +1,8 @@
+# Copyright (c) 2022, Richard Case and Contributors
+# See license.txt
+
+# import frappe
+import unittest
+
+class TestWoocommerceOrderTiming(unittest.TestCase):
+	pass
@@ -0,0 +1,21 @@
+# Copyright (c) 2022, Richard Case and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import add_days, nowdate
+
+# Days of timings kept by clear_old_timings
+KEEP_DAYS = 30
+
+class WoocommerceOrderTiming(Document):
+	pass
+
+def clear_old_timings():
+	"Scheduler: delete timings older than KEEP_DAYS"
+	cutoff = add_days(nowdate(), -KEEP_DAYS)
+	frappe.db.sql("""delete stage from `tabWoocommerce Order Timing Stage` stage
+		inner join `tabWoocommerce Order Timing` timing on timing.name = stage.parent
+		where timing.creation < %s""", cutoff)
+	frappe.db.sql("delete from `tabWoocommerce Order Timing` where creation < %s", cutoff)
+	frappe.db.commit()
@@ -0,0 +1,8 @@
+# Copyright (c) 2022, Richard Case and contributors
+# For license information, please see license.txt
+
+# import frappe
+from frappe.model.document import Document
+
+class WoocommerceOrderTimingStage(Document):
+	pass
@@ -0,0 +1,84 @@
+# Copyright (c) 2022, Slife
+# For license information, please see license.txt
+
+"""
+Named locks so orders can be processed by many workers and nodes in parallel. Orders of the same
+customer, by normalised billing email, are serialised with MariaDB GET_LOCK, which is server wide.
+The locks are taken before the order's transaction reads anything, so its reads see the documents
+committed by the previous holder, and are released after the commit. Items aren't locked, orders
+sharing a product run in parallel and an Item inserted by a concurrent order is read back, see
+woocommerce.insert_missing_items. Wait times and timeouts are counted in Redis, see get_lock_stats.
+"""
+
+import hashlib
+import json
+import time
+
+import frappe
+
+LOCK_TIMEOUT = 30 # seconds
+# Waits longer than this are counted as contended
+CONTENDED_AFTER = 10 # ms
+
+def order_lock_keys(order):
+	"Lock keys of an order dict or payload: its normalised billing email"
+	if isinstance(order, str):
+		order = json.loads(order)
+	email = ((order.get('billing') or {}).get('email') or '').strip().lower()
+	return [f'email:{email}'] if email else []
+
+def acquire(keys, timeout=LOCK_TIMEOUT):
+	"""
+	Take the locks of the keys not already held by this connection, in sorted order to avoid deadlocks.
+	Returns False, after releasing the locks taken here, if one timed out.
+	"""
+	held = _held()
+	taken = []
+	for key in sorted(set(keys) - held):
+		start = time.perf_counter()
+		acquired = frappe.db.sql("select get_lock(%s, %s)", (lock_name(key), timeout))[0][0]
+		wait = (time.perf_counter() - start) * 1000
+		_count('slife_lock_wait_ms', int(wait))
+		if wait > CONTENDED_AFTER:
+			_count('slife_lock_contended')
+		if acquired != 1:
+			_count('slife_lock_timeouts')
+			for key in taken:
+				_release(key)
+				held.discard(key)
+			return False
+		_count('slife_lock_acquired')
+		taken.append(key)
+		held.add(key)
+	return True
+
+def release_all():
+	"Release every lock held by this connection. Call after the commit"
+	for key in _held():
+		_release(key)
+	frappe.local.slife_locks = set()
+
+def lock_name(key):
+	"GET_LOCK names are limited to 64 characters"
+	return f"slife:{hashlib.md5(f'{frappe.local.site}:{key}'.encode()).hexdigest()}"
+
+def _held():
+	if getattr(frappe.local, 'slife_locks', None) is None:
+		frappe.local.slife_locks = set()
+	return frappe.local.slife_locks
+
+def _release(key):
+	frappe.db.sql("select release_lock(%s)", lock_name(key))
+
+@frappe.whitelist()
+def get_lock_stats():
+	"Locks acquired, contended and timed out, and the total wait in ms since the counters were last reset"
+	from frappe.utils import cint
+	frappe.only_for('System Manager')
+	return {
+		stat: cint(frappe.cache().get(frappe.cache().make_key(f'slife_lock_{stat}')))
+		for stat in ('acquired', 'contended', 'timeouts', 'wait_ms')
+	}
+
+def _count(key, amount=1):
+	frappe.cache().incrby(frappe.cache().make_key(key), amount)
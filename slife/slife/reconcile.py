@@ -0,0 +1,90 @@
+# Copyright (c) 2022, Slife
+# For license information, please see license.txt
+
+"""
+Order reconciliation. Webhooks dropped or disabled by Woocommerce are found by reading the orders
+modified since the last run from the REST API and comparing them with their Woocommerce Order Link
+checksum, see woocommerce.order_checksum. Only missing and diverged orders are queued in the
+Woocommerce Inbox. The watermark, in GMT, is kept in Slife Settings orders_modified_after.
+"""
+
+from datetime import datetime, timedelta
+
+import frappe
+
+# Orders modified in the last minutes are left to their webhooks, which may still be in flight
+GRACE = 2 # minutes
+# Orders read by the first run
+FIRST_RUN = 1 # days
+
+def reconcile_hourly():
+	"Scheduler: reconcile orders when Woocommerce Settings reconcile_orders is set"
+	from slife.slife.cache import get_settings
+	if get_settings().reconcile_orders:
+		reconcile()
+
+def reconcile(api=None):
+	"Queue the orders modified since the last run that are missing or diverged. Returns the number queued"
+	from frappe.utils import get_datetime
+	from slife.slife.wc_api import get_api
+
+	api = api or get_api()
+	# Orders are created by the same user as webhook orders
+	frappe.set_user(frappe.db.get_single_value('Woocommerce Settings', 'creation_user') or 'Administrator')
+	modified_before = datetime.utcnow().replace(microsecond=0) - timedelta(minutes=GRACE)
+	modified_after = frappe.db.get_single_value('Slife Settings', 'orders_modified_after')
+	modified_after = get_datetime(modified_after) if modified_after else modified_before - timedelta(days=FIRST_RUN)
+
+	queued = 0
+	for orders in api.get_pages('orders', dates_are_gmt='true', orderby='modified', order='asc',
+		modified_after=modified_after.isoformat(), modified_before=modified_before.isoformat()
+	):
+		for order in find_diverged(orders):
+			enqueue_order(order)
+			queued += 1
+		frappe.db.commit()
+	# Only advanced once every page was read, a failed run starts again from the previous watermark
+	frappe.db.set_value('Slife Settings', None, 'orders_modified_after', modified_before)
+	frappe.db.commit()
+	return queued
+
+def find_diverged(orders):
+	"""
+	Yield the orders whose link checksum differs, and new orders without a Sales Order, unless an event of the
+	order is already queued. Links and queued events are read with one query each per page.
+	"""
+	from slife.slife.woocommerce import NEW_ORDER_STATUSES, order_checksum
+
+	links = {link.name: link for link in frappe.get_all('Woocommerce Order Link',
+		filters={'name': ('in', [order.get('order_key') for order in orders])},
+		fields=['name', 'sales_order', 'checksum'])}
+	queued = set(frappe.get_all('Woocommerce Inbox',
+		filters={'status': ('in', ('Queued', 'Processing')), 'wc_order_id': ('in', [str(order.get('id')) for order in orders])},
+		pluck='wc_order_id'))
+
+	for order in orders:
+		if str(order.get('id')) in queued:
+			continue
+		link = links.get(order.get('order_key'))
+		if link and link.sales_order:
+			if link.checksum != order_checksum(order):
+				yield order
+		elif order.get('status') in NEW_ORDER_STATUSES:
+			yield order
+
+def enqueue_order(order):
+	"Queue an order read from the REST API as an updated event, which creates the order if it has no Sales Order"
+	import json
+	from slife.slife.doctype.woocommerce_inbox.woocommerce_inbox import enqueue, set_order
+
+	doc = frappe.get_doc({
+		'doctype': 'Woocommerce Inbox',
+		'event': 'updated',
+		'resource': 'order',
+		'source': 'reconciliation',
+		'payload': json.dumps(order)
+	})
+	set_order(doc)
+	doc.insert(ignore_permissions=True)
+	enqueue(doc.name)
+	return doc
@@ -0,0 +1,22 @@
+// Copyright (c) 2022, Richard Case and contributors
+// For license information, please see license.txt
+/* eslint-disable */
+
+frappe.query_reports["Woocommerce Stage Timings"] = {
+	"filters": [
+		{
+			"fieldname": "from_date",
+			"label": __("From Date"),
+			"fieldtype": "Date",
+			"default": frappe.datetime.add_days(frappe.datetime.get_today(), -7),
+			"reqd": 1
+		},
+		{
+			"fieldname": "to_date",
+			"label": __("To Date"),
+			"fieldtype": "Date",
+			"default": frappe.datetime.get_today(),
+			"reqd": 1
+		}
+	]
+};
@@ -0,0 +1,62 @@
+# Copyright (c) 2022, Richard Case and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe import _
+from frappe.utils import add_days, flt
+
+from slife.slife.timing import percentiles
+
+def execute(filters=None):
+	"p50/p95 duration and mean DB queries per order pipeline stage, from Woocommerce Order Timing"
+	filters = frappe._dict(filters or {})
+	columns = [
+		{'fieldname': 'stage', 'label': _('Stage'), 'fieldtype': 'Data', 'width': 200},
+		{'fieldname': 'count', 'label': _('Orders'), 'fieldtype': 'Int', 'width': 90},
+		{'fieldname': 'p50', 'label': _('p50 (ms)'), 'fieldtype': 'Float', 'width': 110},
+		{'fieldname': 'p95', 'label': _('p95 (ms)'), 'fieldtype': 'Float', 'width': 110},
+		{'fieldname': 'queries', 'label': _('Mean Queries'), 'fieldtype': 'Float', 'width': 120},
+		{'fieldname': 'query_time', 'label': _('Mean Query Time (ms)'), 'fieldtype': 'Float', 'width': 160}
+	]
+	conditions = (filters.from_date, add_days(filters.to_date, 1))
+
+	# Stages of the background stage jobs, e.g. their warm_up, apart from the stages of the orders
+	rows = frappe.db.sql("""select if(ifnull(timing.job, 'order') = 'order', stage.stage,
+			concat(timing.job, ': ', stage.stage)) as stage, stage.duration, stage.queries, stage.query_time
+		from `tabWoocommerce Order Timing Stage` stage
+		inner join `tabWoocommerce Order Timing` timing on timing.name = stage.parent
+		where timing.creation >= %s and timing.creation < %s
+		order by timing.creation, stage.idx""", conditions, as_dict=True)
+	# The stage jobs run after the order, the total and count are of the orders
+	rows += frappe.db.sql("""select 'total' as stage, duration, queries, query_time
+		from `tabWoocommerce Order Timing`
+		where creation >= %s and creation < %s and ifnull(job, 'order') = 'order'""", conditions, as_dict=True)
+
+	# Stages in pipeline order
+	stages = {}
+	for row in rows:
+		stages.setdefault(row.stage, []).append(row)
+
+	data = []
+	for stage, stage_rows in stages.items():
+		durations = percentiles([flt(row.duration) for row in stage_rows])
+		data.append({
+			'stage': stage,
+			'count': len(stage_rows),
+			'p50': durations['p50'],
+			'p95': durations['p95'],
+			'queries': sum(flt(row.queries) for row in stage_rows) / len(stage_rows),
+			'query_time': sum(flt(row.query_time) for row in stage_rows) / len(stage_rows)
+		})
+
+	chart = {
+		'data': {
+			'labels': [row['stage'] for row in data if row['stage'] != 'total'],
+			'datasets': [
+				{'name': _('p50 (ms)'), 'values': [row['p50'] for row in data if row['stage'] != 'total']},
+				{'name': _('p95 (ms)'), 'values': [row['p95'] for row in data if row['stage'] != 'total']}
+			]
+		},
+		'type': 'bar'
+	}
+	return columns, data, None, chart
@@ -0,0 +1,71 @@
+# Copyright (c) 2022, Slife
+# For license information, please see license.txt
+
+# Run tests with: bench --site <site> --verbose run-tests --module slife.slife.test_address
+
+import unittest
+from unittest.mock import patch
+
+import frappe
+
+from slife.slife.woocommerce import address_key, find_address, set_address_key
+
+class TestAddress(unittest.TestCase):
+	"Customer addresses found through the indexed address key, on stubbed Address rows"
+
+	def setUp(self):
+		self.addresses = []
+		self.filters = []
+
+	def address(self, address_line1, pincode, country, name=None):
+		doc = frappe._dict({'name': name, 'address_line1': address_line1, 'pincode': pincode, 'country': country})
+		set_address_key(doc)
+		if name:
+			self.addresses.append(doc)
+		return doc
+
+	def get_all(self, doctype, filters=None, fields=None, order_by=None):
+		"frappe.get_all on the stored addresses, all of the customer, filtered by the key and the excluded names"
+		self.filters.append(filters)
+		rows = self.addresses
+		for field, operator, value in (f for f in filters if len(f) == 3):
+			if operator == '=':
+				rows = [row for row in rows if row.get(field) == value]
+			elif operator == 'not in':
+				rows = [row for row in rows if row.get(field) not in value]
+		return sorted(rows, key=lambda row: row.name)
+
+	def find(self, new, exclude=None):
+		with patch.object(frappe, 'get_all', side_effect=self.get_all):
+			return find_address(new, 'Test Customer', exclude)
+
+	def test_address_key(self):
+		self.assertEqual(address_key(' SW1A 1AA', 'United Kingdom'), 'sw1a1aa|unitedkingdom')
+		self.assertEqual(address_key('sw1a1aa', 'united kingdom'), address_key('SW1A 1AA', 'United Kingdom'))
+		self.assertIsNone(address_key('', 'United Kingdom'))
+		self.assertIsNone(address_key('SW1A 1AA', None))
+
+	def test_normalised_duplicate(self):
+		self.address('1 Other Road', 'SW1A 1AA', 'United Kingdom', 'ADDR-1')
+		self.address('10 Downing Street', 'SW1A 2AA', 'United Kingdom', 'ADDR-2')
+		self.assertEqual(self.find(self.address(' 10 downing street', 'sw1a2aa', 'united kingdom')), 'ADDR-2')
+		self.assertIn(['woocommerce_address_key', '=', 'sw1a2aa|unitedkingdom'], self.filters[-1])
+		# A different street with the same postcode is another address
+		self.assertIsNone(self.find(self.address('99 Whitehall', 'SW1A 2AA', 'United Kingdom')))
+		# Addresses inserted by the order are not matched again
+		self.assertIsNone(self.find(self.address('10 Downing Street', 'SW1A 2AA', 'United Kingdom'), ['ADDR-2']))
+
+	def test_changed_address_gets_new_key(self):
+		existing = self.address('10 Downing Street', 'SW1A 2AA', 'United Kingdom', 'ADDR-1')
+		old_key = existing.woocommerce_address_key
+		existing.update({'address_line1': '1 Main Street', 'pincode': 'EH1 1AA'})
+		set_address_key(existing)
+		self.assertNotEqual(existing.woocommerce_address_key, old_key)
+		self.assertIsNone(self.find(self.address('10 Downing Street', 'SW1A 2AA', 'United Kingdom')))
+		self.assertEqual(self.find(self.address('1 Main Street', 'EH1 1AA', 'United Kingdom')), 'ADDR-1')
+
+	def test_no_key(self):
+		"Without a postcode any address of the customer is kept, as same_address does"
+		self.address('10 Downing Street', 'SW1A 2AA', 'United Kingdom', 'ADDR-1')
+		self.assertEqual(self.find(self.address('10 Downing Street', '', 'United Kingdom')), 'ADDR-1')
+		self.assertFalse([f for f in self.filters[-1] if f[0] == 'woocommerce_address_key'])
@@ -0,0 +1,46 @@
+# Copyright (c) 2022, Slife
+# For license information, please see license.txt
+
+# Run tests with: bench --site <site> --verbose run-tests --module slife.slife.test_benchmark
+
+import unittest
+
+from slife.slife.benchmark import generate_orders
+from slife.slife.timing import percentiles
+
+class TestBenchmark(unittest.TestCase):
+	"Synthetic order generation. Replaying is done by `bench slife-benchmark` against a local site"
+
+	def test_generate_orders(self):
+		orders = list(generate_orders(20, lines=5, repeat_customers=0.5, addresses=2, seed=1))
+		self.assertEqual(len(orders), 20)
+		self.assertEqual(len({order['order_key'] for order in orders}), 20)
+		self.assertLess(len({order['billing']['email'] for order in orders}), 20)
+		for order in orders:
+			self.assertEqual(len(order['line_items']), 5)
+			self.assertEqual(order['total'],
+				sum(line['total'] for line in order['line_items']) + float(order['shipping_total']))
+
+	def test_addresses(self):
+		"A customer's addresses are distinct candidates for same_address"
+		from difflib import SequenceMatcher
+		from slife.slife.benchmark import benchmark_address
+		addresses = [benchmark_address(n, '6789') for n in range(20)]
+		for i, a in enumerate(addresses):
+			for b in addresses[i + 1:]:
+				if a['postcode'] == b['postcode']:
+					# same_address threshold
+					self.assertLess(SequenceMatcher(None, a['address_1'].lower(), b['address_1'].lower()).ratio(), 0.8)
+
+	def test_variants(self):
+		"Only the requested number of attributes vary"
+		def values(order):
+			return {(meta['key'], meta['value']) for line in order['line_items'] for meta in line['meta_data']}
+		fixed = list(generate_orders(10, attributes=0, seed=1))
+		self.assertEqual(len(set.union(*map(values, fixed))), len(values(fixed[0])))
+		varied = list(generate_orders(10, attributes=1, variants=5, seed=1))
+		self.assertGreater(len(set.union(*map(values, varied))), len(values(varied[0])))
+
+	def test_percentiles(self):
+		self.assertEqual(percentiles(range(1, 101)), {'p50': 50, 'p95': 95, 'p99': 99})
+		self.assertEqual(percentiles([]), {})
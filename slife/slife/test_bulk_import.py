@@ -0,0 +1,68 @@
+# Copyright (c) 2022, Slife
+# For license information, please see license.txt
+
+# Run tests with: bench --site <site> --verbose run-tests --module slife.slife.test_bulk_import
+
+import json
+import os
+import tempfile
+import unittest
+
+from slife.slife import bulk_import
+from slife.slife.bulk_import import get_partition, read_orders
+
+class TestBulkImport(unittest.TestCase):
+	"Reading export files. The import itself runs _order, see test_woocommerce"
+
+	orders = [{'id': i, 'billing': {'email': f'customer{i % 3}@example.com'}} for i in range(5)]
+
+	def read(self, text):
+		with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+			f.write(text)
+		try:
+			return list(read_orders(f.name))
+		finally:
+			os.unlink(f.name)
+
+	def test_json_lines(self):
+		text = '\n'.join(json.dumps(order) for order in self.orders) + '\n\n'
+		self.assertEqual(self.read(text), self.orders)
+
+	def test_rest_pages(self):
+		text = json.dumps(self.orders[:3]) + '\n' + json.dumps(self.orders[3:])
+		self.assertEqual(self.read(text), self.orders)
+
+	def test_json_list(self):
+		self.assertEqual(self.read(json.dumps(self.orders, indent=4)), self.orders)
+
+	def test_small_chunks(self):
+		"Orders and lists span several reads"
+		chunk_size = bulk_import.CHUNK_SIZE
+		bulk_import.CHUNK_SIZE = 7
+		try:
+			self.assertEqual(self.read(json.dumps(self.orders, indent=4)), self.orders)
+			text = json.dumps(self.orders[:3]) + '\n' + '\n'.join(json.dumps(order) for order in self.orders[3:])
+			self.assertEqual(self.read(text), self.orders)
+		finally:
+			bulk_import.CHUNK_SIZE = chunk_size
+
+	def test_list_read_incrementally(self):
+		"The first order of a list is read before the rest of the file"
+		with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+			f.write(json.dumps(self.orders) + '\n' + 'x' * (bulk_import.CHUNK_SIZE * 2))
+		try:
+			orders = read_orders(f.name)
+			self.assertEqual([next(orders) for order in self.orders], self.orders)
+			with self.assertRaises(ValueError):
+				next(orders)
+		finally:
+			os.unlink(f.name)
+
+	def test_invalid_json(self):
+		with self.assertRaises(ValueError):
+			self.read(json.dumps(self.orders)[:-5])
+
+	def test_partition_by_email(self):
+		for order in self.orders:
+			same_customer = {'billing': {'email': f" {order['billing']['email'].upper()}"}}
+			self.assertEqual(get_partition(order, 4), get_partition(same_customer, 4))
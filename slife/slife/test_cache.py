@@ -0,0 +1,166 @@
+# Copyright (c) 2022, Slife
+# For license information, please see license.txt
+
+# Run tests with: bench --site <site> --verbose run-tests --module slife.slife.test_cache
+
+import unittest
+from unittest.mock import patch
+
+import frappe
+from frappe.utils import add_days, getdate
+
+from slife.slife.cache import (COUPON_VERSION_KEY, _caches, _get_cache, clear, coupon_changed, get_active_coupon,
+	get_cached, get_exchange_rate, get_exchange_rate_stats, get_lru, invalidate, invalidate_exchange_rates)
+
+class TestCache(unittest.TestCase):
+	"Process caches emptied through their Redis version key"
+
+	version_key = 'slife_test_cache_version'
+
+	def setUp(self):
+		self.computed = []
+
+	def tearDown(self):
+		_caches.pop((frappe.local.site, self.version_key), None)
+		frappe.cache().delete_value(self.version_key)
+
+	def compute(self, key):
+		"A compute() callback counting its calls"
+		def compute():
+			self.computed.append(key)
+			return f'{key}{len(self.computed)}'
+		return compute
+
+	def lru(self, key, size=3):
+		return get_lru(self.version_key, key, self.compute(key), size)
+
+	def test_version_bump_recomputes(self):
+		self.assertEqual(self.lru('a'), 'a1')
+		self.assertEqual(self.lru('a'), 'a1')
+		self.assertEqual(self.computed, ['a'])
+		# Another process invalidating the cache
+		frappe.cache().set_value(self.version_key, frappe.generate_hash(length=10))
+		self.assertEqual(self.lru('a'), 'a2')
+		self.assertEqual(self.computed, ['a', 'a'])
+
+	def test_clear(self):
+		cache = _get_cache(self.version_key)
+		self.lru('a')
+		clear(self.version_key)
+		self.assertIsNot(_get_cache(self.version_key), cache)
+		self.assertEqual(self.lru('a'), 'a2')
+
+	def test_invalidate(self):
+		get_cached('slife_test', self.compute('a'))
+		self.assertEqual(get_cached('slife_test', self.compute('a')), 'a1')
+		invalidate()
+		self.assertEqual(get_cached('slife_test', self.compute('a')), 'a2')
+
+	def test_lru_evicts_least_recently_used(self):
+		for key in 'abc':
+			self.lru(key)
+		# a is used again, b is now the least recently used
+		self.lru('a')
+		self.lru('d')
+		self.assertEqual(list(_get_cache(self.version_key)['lru']), ['c', 'a', 'd'])
+		self.assertEqual(self.computed, ['a', 'b', 'c', 'd'])
+		self.lru('b')
+		self.assertEqual(self.computed, ['a', 'b', 'c', 'd', 'b'])
+		self.assertEqual(len(_get_cache(self.version_key)['lru']), 3)
+
+class TestCoupons(unittest.TestCase):
+	"get_active_coupon on a stubbed coupon index"
+
+	company = '_Test Company'
+
+	def setUp(self):
+		today = getdate()
+		self.today = today
+		coupons = [
+			self.coupon('OTHER-COMPANY', company='_Test Company 1'),
+			self.coupon('NOT-YET', valid_from=add_days(today, 1)),
+			self.coupon('EXPIRED', valid_upto=add_days(today, -1)),
+			self.coupon('RULE-NOT-YET', rule_valid_from=add_days(today, 1)),
+			self.coupon('RULE-EXPIRED', rule_valid_upto=add_days(today, -10)),
+			self.coupon('LIMITED', maximum_use=2),
+			self.coupon('ANY-COMPANY', company=None),
+			self.coupon('SAVE10', coupon_code='save10')
+		]
+		index = {coupon.coupon_code.lower(): coupon for coupon in coupons}
+		_get_cache(COUPON_VERSION_KEY)['index'] = index
+
+	def tearDown(self):
+		_caches.pop((frappe.local.site, COUPON_VERSION_KEY), None)
+
+	def coupon(self, name, **values):
+		return frappe._dict({'name': name, 'coupon_code': name, 'pricing_rule': f'{name} Rule',
+			'maximum_use': 0, 'valid_from': None, 'valid_upto': None, 'company': self.company,
+			'rule_valid_from': None, 'rule_valid_upto': None}, **values)
+
+	def active(self, *codes, transaction_date=None):
+		return get_active_coupon(codes, self.company, transaction_date or self.today)
+
+	def test_company(self):
+		self.assertIsNone(self.active('other-company'))
+		self.assertEqual(self.active('any-company'), 'ANY-COMPANY')
+
+	def test_coupon_dates_against_today(self):
+		self.assertIsNone(self.active('not-yet'))
+		self.assertIsNone(self.active('expired'))
+		# Also for a back-dated order, as erpnext validate_coupon_code does
+		self.assertIsNone(self.active('expired', transaction_date=add_days(self.today, -5)))
+
+	def test_rule_dates_against_transaction_date(self):
+		self.assertIsNone(self.active('rule-not-yet'))
+		self.assertEqual(self.active('rule-not-yet', transaction_date=add_days(self.today, 1)), 'RULE-NOT-YET')
+		self.assertIsNone(self.active('rule-expired'))
+		self.assertEqual(self.active('rule-expired', transaction_date=add_days(self.today, -20)), 'RULE-EXPIRED')
+
+	def test_maximum_use(self):
+		with patch.object(frappe.db, 'get_value', return_value=2) as get_value:
+			self.assertIsNone(self.active('limited'))
+		get_value.assert_called_once_with('Coupon Code', 'LIMITED', 'used')
+		with patch.object(frappe.db, 'get_value', return_value=1):
+			self.assertEqual(self.active('limited'), 'LIMITED')
+		# Unlimited coupons don't read the used count
+		with patch.object(frappe.db, 'get_value') as get_value:
+			self.assertEqual(self.active('any-company'), 'ANY-COMPANY')
+		get_value.assert_not_called()
+
+	def test_first_active_code(self):
+		self.assertEqual(self.active('unknown', None, 'expired', ' Save10 ', 'any-company'), 'SAVE10')
+		self.assertIsNone(self.active('unknown', 'expired'))
+		self.assertIsNone(self.active())
+
+	def test_coupon_changed(self):
+		doc = frappe.get_doc({'doctype': 'Coupon Code', 'coupon_code': 'SAVE10', 'pricing_rule': 'SAVE10 Rule',
+			'maximum_use': 10, 'used': 1})
+		self.assertTrue(coupon_changed(doc))
+		doc._doc_before_save = frappe.copy_doc(doc)
+		# Each submitted order using the coupon only counts it
+		doc.used = 2
+		self.assertFalse(coupon_changed(doc))
+		doc.valid_upto = self.today
+		self.assertTrue(coupon_changed(doc))
+
+class TestExchangeRates(unittest.TestCase):
+	"Exchange rates cached in Redis per transaction date"
+
+	def setUp(self):
+		invalidate_exchange_rates()
+
+	def tearDown(self):
+		invalidate_exchange_rates()
+
+	def test_keyed_by_transaction_date(self):
+		rates = {'2021-01-04': 1.1, '2021-01-05': 1.2}
+		stats = get_exchange_rate_stats()
+		with patch('erpnext.setup.utils.get_exchange_rate',
+				side_effect=lambda from_currency, to_currency, transaction_date: rates[transaction_date]) as rate:
+			for i in range(2):
+				for date, expected in rates.items():
+					self.assertEqual(float(get_exchange_rate('USD', 'EUR', getdate(date))), expected)
+		# Looked up once per date, with the date of the order
+		self.assertEqual([call.args for call in rate.call_args_list],
+			[('USD', 'EUR', '2021-01-04'), ('USD', 'EUR', '2021-01-05')])
+		self.assertEqual(get_exchange_rate_stats(), {'hits': stats['hits'] + 2, 'misses': stats['misses'] + 2})
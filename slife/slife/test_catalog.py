@@ -0,0 +1,156 @@
+# Copyright (c) 2022, Slife
+# For license information, please see license.txt
+
+# Run tests with: bench --site <site> --verbose run-tests --module slife.slife.test_catalog
+
+import base64
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from slife.slife.catalog import get_attributes, product_line_item, sync_product, variation_line_item
+from slife.slife.wc_api import API_PATH, WoocommerceAPI
+
+class StubWoocommerce:
+	"""
+	Local stand-in for the Woocommerce REST API. Serves the lists in routes, e.g. {'products': [...]},
+	paged like Woocommerce and with basic authentication. The requests made are kept in requests.
+	"""
+
+	def __init__(self, routes, key='ck_test', secret='cs_test'):
+		stub = self
+		self.routes = routes
+		self.requests = []
+		self.auth = 'Basic ' + base64.b64encode(f'{key}:{secret}'.encode()).decode()
+
+		class Handler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				url = urlparse(self.path)
+				params = {k: v[0] for k, v in parse_qs(url.query).items()}
+				stub.requests.append((url.path, params))
+				records = stub.routes.get(url.path[len(API_PATH):])
+				if self.headers.get('Authorization') != stub.auth:
+					return self.send(401, {'code': 'woocommerce_rest_cannot_view'})
+				if records is None:
+					return self.send(404, {'code': 'rest_no_route'})
+				page, per_page = int(params.get('page', 1)), int(params.get('per_page', 10))
+				total_pages = -(-len(records) // per_page)
+				self.send(200, records[(page - 1) * per_page:page * per_page], {'X-WP-TotalPages': str(total_pages)})
+
+			def send(self, status, body, headers={}):
+				data = json.dumps(body).encode()
+				self.send_response(status)
+				self.send_header('Content-Type', 'application/json')
+				self.send_header('Content-Length', str(len(data)))
+				for header, value in headers.items():
+					self.send_header(header, value)
+				self.end_headers()
+				self.wfile.write(data)
+
+			def log_message(self, *args):
+				pass
+
+		self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+		self.url = f'http://127.0.0.1:{self.server.server_port}'
+		threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+	def api(self, key='ck_test', secret='cs_test'):
+		return WoocommerceAPI(self.url, key, secret)
+
+	def close(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+class TestCatalog(unittest.TestCase):
+	"REST API paging and the mapping of products to order line items. Item creation runs make_item, see test_woocommerce"
+
+	attributes = [{'id': 1, 'name': 'Colour', 'slug': 'pa_colour'}]
+	terms = [{'id': 10, 'name': 'Blue', 'slug': 'blue_10'}, {'id': 11, 'name': 'Red', 'slug': 'red_11'}]
+	product = {'id': 5, 'sku': '11111111', 'name': 'Bowl Sweden', 'type': 'variable'}
+
+	def setUp(self):
+		self.stub = StubWoocommerce({
+			'products': [{'id': i, 'sku': str(i), 'name': f'Product {i}', 'type': 'simple'} for i in range(250)],
+			'products/attributes': self.attributes,
+			'products/attributes/1/terms': self.terms
+		})
+
+	def tearDown(self):
+		self.stub.close()
+
+	def test_get_all_pages(self):
+		products = list(self.stub.api().get_all('products', modified_after='2022-03-01T00:00:00'))
+		self.assertEqual([p['id'] for p in products], list(range(250)))
+		self.assertEqual([params['page'] for path, params in self.stub.requests], ['1', '2', '3'])
+		self.assertEqual(self.stub.requests[0][1]['modified_after'], '2022-03-01T00:00:00')
+
+	def test_authentication(self):
+		import requests
+		with self.assertRaises(requests.HTTPError):
+			self.stub.api(secret='wrong').get('products')
+
+	def test_variation_line_item(self):
+		attributes = get_attributes(self.stub.api())
+		variation = {'id': 7, 'attributes': [
+			{'id': 1, 'name': 'Colour', 'option': 'Red'},
+			{'id': 0, 'name': 'Engraving', 'option': 'None'}
+		]}
+		# Keyed like the meta_data of order line items, by the prefixed Item Attribute name
+		self.assertEqual(variation_line_item(self.product, variation, attributes, '_uni_item_'), {
+			'sku': '11111111',
+			'name': 'Bowl Sweden',
+			'meta_data': [{'key': '_uni_item_colour', 'value': 'red_11'}, {'key': '_uni_item_Engraving', 'value': 'None'}]
+		})
+
+	def test_any_attribute_variation(self):
+		variation = {'id': 8, 'attributes': [{'id': 1, 'name': 'Colour', 'option': ''}]}
+		self.assertIsNone(variation_line_item(self.product, variation, {}, '_uni_item_'))
+
+	def test_product_line_item(self):
+		self.assertEqual(product_line_item({'sku': '1', 'name': 'Cup', 'type': 'simple'}),
+			{'sku': '1', 'name': 'Cup', 'meta_data': []})
+
+class TestSyncProduct(unittest.TestCase):
+	"A variable product synced end to end from the stub: its Item template and a variant per variation"
+
+	def setUp(self):
+		import frappe
+		if not frappe.db.exists('Item Attribute', 'slife_test_colour'):
+			frappe.get_doc({
+				'doctype': 'Item Attribute',
+				'attribute_name': 'slife_test_colour',
+				'item_attribute_values': [
+					{'attribute_value': 'blue', 'abbr': 'BLU'},
+					{'attribute_value': 'red', 'abbr': 'RED'}
+				]
+			}).insert(ignore_permissions=True)
+		self.sku = f'CAT{frappe.generate_hash(length=8)}'
+		self.product = {'id': 5, 'sku': self.sku, 'name': 'Catalog Bowl', 'type': 'variable',
+			'attributes': [{'id': 1, 'name': 'Test Colour', 'variation': True, 'options': ['Blue', 'Red']}]}
+		self.stub = StubWoocommerce({
+			'products/attributes': [{'id': 1, 'name': 'Test Colour', 'slug': 'pa_slife_test_colour'}],
+			'products/attributes/1/terms': [{'id': 10, 'name': 'Blue', 'slug': 'blue'}, {'id': 11, 'name': 'Red', 'slug': 'red'}],
+			'products/5/variations': [
+				{'id': 6, 'attributes': [{'id': 1, 'name': 'Test Colour', 'option': 'Blue'}]},
+				{'id': 7, 'attributes': [{'id': 1, 'name': 'Test Colour', 'option': 'Red'}]}
+			]
+		})
+
+	def tearDown(self):
+		import frappe
+		self.stub.close()
+		frappe.db.rollback()
+
+	def test_sync_product(self):
+		import frappe
+		from slife.slife import woocommerce
+		from slife.slife.cache import get_default_warehouse, get_settings
+
+		woocommerce.woocommerce_settings = settings = get_settings()
+		api = self.stub.api()
+		sync_product(api, self.product, get_attributes(api), get_default_warehouse(settings.company))
+		self.assertTrue(frappe.db.get_value('Item', self.sku, 'has_variants'))
+		self.assertEqual(sorted(frappe.get_all('Item', filters={'variant_of': self.sku}, pluck='item_code')),
+			[f'{self.sku}-blue', f'{self.sku}-red'])
@@ -0,0 +1,45 @@
+# Copyright (c) 2022, Slife
+# For license information, please see license.txt
+
+# Run tests with: bench --site <site> --verbose run-tests --module slife.slife.test_locks
+
+import unittest
+
+import frappe
+
+from slife.slife.cache import get_settings
+from slife.slife.locks import acquire, lock_name, order_lock_keys, release_all
+
+class TestLocks(unittest.TestCase):
+	"Customer locks of orders"
+
+	def order(self, email, value):
+		prefix = get_settings().attribute_key_prefix
+		return {
+			'billing': {'email': email},
+			'line_items': [{'sku': '11111111', 'meta_data': [
+				{'key': '_add-to-cart', 'value': '24300'},
+				{'key': f'{prefix}height', 'value': value},
+				{'key': f'{prefix}depth', 'value': '50'}
+			]}]
+		}
+
+	def tearDown(self):
+		release_all()
+
+	def test_order_lock_keys(self):
+		keys = order_lock_keys(self.order(' Customer@Example.com', '72'))
+		self.assertEqual(keys, ['email:customer@example.com'])
+		# Orders sharing a product aren't serialised
+		self.assertEqual(keys, order_lock_keys(self.order('customer@example.com', '77')))
+
+	def test_acquire_release(self):
+		keys = order_lock_keys(self.order('locks@example.com', '72'))
+		self.assertTrue(acquire(keys))
+		# Held locks are not taken twice
+		self.assertTrue(acquire(keys))
+		for key in keys:
+			self.assertTrue(frappe.db.sql("select is_used_lock(%s)", lock_name(key))[0][0])
+		release_all()
+		for key in keys:
+			self.assertIsNone(frappe.db.sql("select is_used_lock(%s)", lock_name(key))[0][0])
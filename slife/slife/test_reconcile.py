@@ -0,0 +1,61 @@
+# Copyright (c) 2022, Slife
+# For license information, please see license.txt
+
+# Run tests with: bench --site <site> --verbose run-tests --module slife.slife.test_reconcile
+
+import unittest
+
+import frappe
+
+from slife.slife.reconcile import find_diverged, reconcile
+from slife.slife.test_catalog import StubWoocommerce
+from slife.slife.woocommerce import order_checksum
+
+class TestReconcile(unittest.TestCase):
+	"Finding missing & diverged orders, against a local stub of the REST API"
+
+	def tearDown(self):
+		frappe.db.rollback()
+
+	def order(self, status, **fields):
+		h = frappe.generate_hash(length=13)
+		order = {'id': h, 'order_key': f'wc_order_{h}', 'status': status, 'date_modified': '2022-03-29T10:00:00'}
+		order.update(fields)
+		return order
+
+	def link(self, order, checksum):
+		doc = frappe.get_doc({
+			'doctype': 'Woocommerce Order Link',
+			'order_key': order['order_key'],
+			'wc_order_id': order['id'],
+			'sales_order': 'SO-TEST',
+			'checksum': checksum
+		})
+		doc.flags.ignore_links = True
+		doc.insert(ignore_permissions=True)
+
+	def test_find_diverged(self):
+		new = self.order('processing')
+		cancelled = self.order('cancelled')
+		unchanged = self.order('processing')
+		self.link(unchanged, order_checksum(unchanged))
+		diverged = self.order('on-hold')
+		self.link(diverged, order_checksum(dict(diverged, status='processing')))
+		orders = [new, cancelled, unchanged, diverged]
+		self.assertEqual([order['id'] for order in find_diverged(orders)], [new['id'], diverged['id']])
+
+	def test_watermark(self):
+		previous = frappe.db.get_single_value('Slife Settings', 'orders_modified_after')
+		frappe.db.set_value('Slife Settings', None, 'orders_modified_after', '2022-03-29 10:00:00')
+		stub = StubWoocommerce({'orders': []})
+		try:
+			self.assertEqual(reconcile(stub.api()), 0)
+			path, params = stub.requests[0]
+			self.assertEqual(params['modified_after'], '2022-03-29T10:00:00')
+			self.assertEqual(str(frappe.db.get_single_value('Slife Settings', 'orders_modified_after')),
+				params['modified_before'].replace('T', ' '))
+		finally:
+			stub.close()
+			frappe.set_user('Administrator')
+			frappe.db.set_value('Slife Settings', None, 'orders_modified_after', previous)
+			frappe.db.commit()
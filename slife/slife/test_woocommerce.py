@@ -12,7 +12,7 @@ class TestWoocommerce(unittest.TestCase):
 	Requires:
 	Frappe & ERPNext after v13.11.0 for SO coupon discount support
 	Matching Coupon Codes + Net Total Pricing Rule (transaction-based only)
-	 - ERPNext only supports one coupon code, the "code" WC field must match the ERPNext "name" field
+	 - ERPNext only supports one coupon code, the first WC "code" matching an ERPNext coupon name or code is used
 	Woocommerce settings configured
 	 - mandatory fields
 	 - secret
@@ -48,7 +48,7 @@ class TestWoocommerce(unittest.TestCase):
 		frappe.db.close()
 
 	@classmethod
-	def send_order(cls, text):
+	def send_order(cls, text, event='created'):
 		"Mimic woocommerce order hook submission"
 		import requests, base64, hmac, hashlib, json
 		woocommerce_settings = frappe.get_doc("Woocommerce Settings")
@@ -63,7 +63,8 @@ class TestWoocommerce(unittest.TestCase):
 		url = site + '/api/method/slife.slife.woocommerce.order'
 		headers = {
 			'X-Frappe-CSRF-Token': 'None',
-			'x-wc-webhook-event': 'created',
+			'x-wc-webhook-resource': 'order',
+			'x-wc-webhook-event': event,
 			'x-wc-webhook-signature': sig
 		}
 		r = requests.post(url, headers=headers, data=text)
@@ -80,6 +81,31 @@ class TestWoocommerce(unittest.TestCase):
 			raise
 		# Seems to use the wrong data for validation if not closed
 		frappe.db.close()
+		return cls.wait_for_inbox(r.json().get('message'))
+
+	@classmethod
+	def wait_for_inbox(cls, inbox, timeout=120):
+		"Orders are processed by a background worker, wait for the queued Woocommerce Inbox entry"
+		import time
+		for i in range(timeout):
+			status = frappe.db.get_value('Woocommerce Inbox', inbox, 'status')
+			frappe.db.close()
+			if status in ('Processed', 'Failed', 'Superseded'):
+				break
+			time.sleep(1)
+		return frappe.get_doc('Woocommerce Inbox', inbox)
+
+	@classmethod
+	def wait_for_stages(cls, order_key, timeout=120):
+		"The Sales Invoice & RFQ are created by background jobs, wait for the Woocommerce Order Link stages"
+		import time
+		for i in range(timeout):
+			status = frappe.db.get_value('Woocommerce Order Link', order_key, 'stage_status')
+			frappe.db.close()
+			if status != 'Queued':
+				break
+			time.sleep(1)
+		return frappe.get_doc('Woocommerce Order Link', order_key)
 
 	@classmethod
 	def get_order(cls, filename):
@@ -96,6 +122,7 @@ class TestWoocommerce(unittest.TestCase):
 	def validate_order(self, text):
 		import json
 		from frappe.utils import flt
+		from slife.slife.doctype.woocommerce_order_archive.woocommerce_order_archive import get_order_json
 		order = json.loads(text)
 		billing = order.get('billing')
 
@@ -111,7 +138,9 @@ class TestWoocommerce(unittest.TestCase):
 		self.assertTrue(bool(customer.customer_primary_address))
 		# Test Sales Order
 		order_code = order.get("order_key").rpartition("_")[2]
-		so = frappe.get_doc('Sales Order', {'po_no': ('=', f'{order_code}')})
+		link = frappe.get_doc('Woocommerce Order Link', order.get("order_key"))
+		self.assertEqual(link.wc_order_id, str(order.get("id")))
+		so = frappe.get_doc('Sales Order', link.sales_order)
 		self.assertEqual(so.customer, customer.name)
 		self.assertEqual(so.po_no, order_code)
 		self.assertEqual(so.customer_address, customer.customer_primary_address)
@@ -127,20 +156,25 @@ class TestWoocommerce(unittest.TestCase):
 		# Shipping charge & tax is included in WC total
 		self.assertEqual(flt(so.grand_total), flt(order.get("total")))
 		self.assertEqual(flt(so.total_taxes_and_charges), flt(order.get("total_tax")) + flt(order.get("shipping_total")))
-		self.assertTrue(bool(so.woocommerce_order_json))
+		archived = json.loads(get_order_json(so.name))
+		self.assertEqual(archived.get("order_key"), order.get("order_key"))
 
 		if order.get('status') != 'pending':
+			link = self.wait_for_stages(order.get("order_key"))
+			self.assertEqual(link.stage_status, 'Completed', link.stage_error)
 			# Test Sales Invoice
-			si = frappe.get_cached_doc('Sales Invoice', {'po_no': ('=', f'{order_code}')})
-			self.assertTrue(bool(si))
+			si = frappe.get_cached_doc('Sales Invoice', link.sales_invoice)
+			self.assertEqual(si.po_no, order_code)
 			# Test RFQ
-			rfq = frappe.get_cached_doc('Request for Quotation', {'rfq_number': ('=', f'{order_code}')})
-			self.assertTrue(bool(rfq))
+			rfq = frappe.get_cached_doc('Request for Quotation', link.request_for_quotation)
+			self.assertEqual(rfq.rfq_number, order_code)
+			self.assertTrue(bool(link.material_request))
 		return so
 
 	def run_test_from_file(self, filename):
 		order = self.get_order(filename)
-		self.send_order(order)
+		inbox = self.send_order(order)
+		self.assertEqual(inbox.status, 'Processed', inbox.error)
 		return (order, self.validate_order(order))
 
 	def test_order_1(self):
@@ -165,13 +199,125 @@ class TestWoocommerce(unittest.TestCase):
 
 	def test_order_5(self):
 		"Pending order, no template fail"
-		import requests
 		order = self.get_order('test_order_5.json')
-		with self.assertRaises(requests.HTTPError) as obj:
-			self.send_order(order)
-		self.assertEqual(obj.exception.response.status_code, 404)
-		self.assertEqual(obj.exception.response.reason, 'NOT FOUND')
+		inbox = self.send_order(order)
+		self.assertEqual(inbox.status, 'Failed')
+		self.assertIn('DoesNotExistError', inbox.error)
+		# Kept for replay
+		letter = frappe.get_doc('Woocommerce Dead Letter', {'inbox': inbox.name})
+		self.assertEqual(letter.status, 'Open')
+		self.assertEqual(letter.error_class, 'DoesNotExistError')
+		self.assertEqual(letter.stage, 'get_items')
+		self.assertEqual(letter.attempts, 1)
+		self.assertEqual(letter.signature, inbox.signature)
+		self.assertEqual(letter.payload, order)
 
 	def test_order_6(self):
 		"Pending order, no coupon"
 		self.run_test_from_file('test_order_6.json')
+
+	def test_order_coupons(self):
+		"The first active coupon of several is set, unknown codes are skipped and every code is recorded"
+		import json
+		data = json.loads(self.get_order('test_order_2.json'))
+		data['coupon_lines'].insert(0, dict(data['coupon_lines'][0], code='test_unknown_coupon'))
+		order = json.dumps(data)
+		inbox = self.send_order(order)
+		self.assertEqual(inbox.status, 'Processed', inbox.error)
+		so = self.validate_order(order)
+		self.assertEqual(so.coupon_code, 'test_coupon_order_624')
+		self.assertEqual(so.woocommerce_coupons, 'test_unknown_coupon, test_coupon_order_624')
+
+	def test_duplicate_delivery(self):
+		"A repeated created webhook must not create a second Sales Order"
+		order, so = self.run_test_from_file('test_order_6.json')
+		inbox = self.send_order(order)
+		self.assertEqual(inbox.status, 'Processed', inbox.error)
+		self.assertEqual(frappe.db.count('Sales Order', {'po_no': so.po_no}), 1)
+
+	def test_order_updated(self):
+		"A pending order updated to processing submits the Sales Order and creates the Sales Invoice"
+		import json
+		order, so = self.run_test_from_file('test_order_6.json')
+		self.assertEqual(so.docstatus, 0)
+		data = json.loads(order)
+		data['status'] = 'processing'
+		data['date_modified'] = frappe.utils.now_datetime().isoformat(timespec='seconds')
+		order = json.dumps(data)
+		inbox = self.send_order(order, 'updated')
+		self.assertEqual(inbox.status, 'Processed', inbox.error)
+		link = self.wait_for_stages(data['order_key'])
+		self.assertEqual(link.wc_status, 'processing')
+		self.assertEqual(link.stage_status, 'Completed', link.stage_error)
+		self.assertEqual(frappe.db.get_value('Sales Order', so.name, 'docstatus'), 1)
+		self.assertEqual(frappe.db.get_value('Sales Invoice', link.sales_invoice, 'docstatus'), 1)
+		# Redelivery of the same update is a no-op
+		inbox = self.send_order(order, 'updated')
+		self.assertEqual(inbox.status, 'Processed', inbox.error)
+		self.assertEqual(frappe.db.count('Sales Invoice', {'po_no': so.po_no}), 1)
+
+	def test_order_completed_coalesced(self):
+		"A created (processing) event superseded by an updated (completed) one still creates the order"
+		import json
+		from slife.slife.doctype.woocommerce_inbox.woocommerce_inbox import process, set_order
+		data = json.loads(self.get_order('test_order_4.json'))
+		data['id'] = frappe.generate_hash(length=10)
+		data['status'] = 'processing'
+		created = json.dumps(data)
+		data['status'] = 'completed'
+		data['date_modified'] = frappe.utils.now_datetime().isoformat(timespec='seconds')
+		completed = json.dumps(data)
+		names = []
+		for event, payload in (('created', created), ('updated', completed)):
+			doc = frappe.get_doc({'doctype': 'Woocommerce Inbox', 'resource': 'order', 'event': event, 'payload': payload})
+			set_order(doc)
+			doc.insert(ignore_permissions=True)
+			names.append(doc.name)
+		frappe.db.commit()
+		process()
+		self.assertEqual(frappe.db.get_value('Woocommerce Inbox', names[0], 'status'), 'Superseded')
+		inbox = frappe.get_doc('Woocommerce Inbox', names[1])
+		self.assertEqual(inbox.status, 'Processed', inbox.error)
+		so = self.validate_order(completed)
+		self.assertEqual(so.docstatus, 1)
+
+	def test_order_updated_without_link(self):
+		"An update for an unknown order creates it"
+		order = self.get_order('test_order_6.json')
+		inbox = self.send_order(order, 'updated')
+		self.assertEqual(inbox.status, 'Processed', inbox.error)
+		self.validate_order(order)
+
+	def test_consolidated_rfq(self):
+		"Outsourced orders are collected into one RFQ per supplier by the scheduler"
+		import json
+		from slife.slife.consolidation import consolidate, get_outstanding_orders
+		settings = frappe.get_doc('Woocommerce Settings')
+		settings.rfq_consolidation = 'Hourly'
+		settings.save()
+		frappe.db.commit()
+		try:
+			orders = [self.get_order('test_order_4.json') for i in range(2)]
+			for order in orders:
+				inbox = self.send_order(order)
+				self.assertEqual(inbox.status, 'Processed', inbox.error)
+			links = [self.wait_for_stages(json.loads(order)['order_key']) for order in orders]
+			for link in links:
+				self.assertEqual(link.stage_status, 'Completed', link.stage_error)
+				self.assertFalse(link.request_for_quotation)
+			consolidate()
+			rfqs = {frappe.db.get_value('Woocommerce Order Link', link.name, 'request_for_quotation') for link in links}
+			self.assertEqual(len(rfqs), 1)
+			rfq = frappe.get_doc('Request for Quotation', rfqs.pop())
+			rfq_numbers = {item.rfq_number for item in rfq.items}
+			for link in links:
+				self.assertIn(frappe.db.get_value('Sales Order', link.sales_order, 'po_no'), rfq_numbers)
+			# Every item was requested, the orders aren't consolidated again
+			outstanding = {order.sales_order for order in get_outstanding_orders(settings.company)}
+			for link in links:
+				self.assertNotIn(link.sales_order, outstanding)
+		finally:
+			settings.reload()
+			settings.rfq_consolidation = ''
+			settings.save()
+			frappe.db.commit()
@@ -0,0 +1,138 @@
+# Copyright (c) 2022, Slife
+# For license information, please see license.txt
+
+"""
+Per stage timing of the order pipeline. Each stage records its duration and the number and
+duration of its DB queries, saved per order in Woocommerce Order Timing when the
+Woocommerce Settings record_timings option is set. See the Woocommerce Stage Timings report.
+"""
+
+import math
+import time
+from contextlib import contextmanager
+
+import frappe
+
+def start(**stages):
+	"Start timing an order. Stages timed before the order was queued can be passed in ms, e.g. verify_request=1.2"
+	frappe.local.slife_timing = frappe._dict(start=time.perf_counter(), stages=[], current=None, failed=None,
+		queries=0, query_time=0.0)
+	for name, duration in stages.items():
+		if duration is not None:
+			frappe.local.slife_timing.stages.append(frappe._dict(stage=name, duration=duration, queries=0, query_time=0))
+
+@contextmanager
+def stage(name, merge=False):
+	"""
+	Time a stage of the order started by start(). Nested stages are included in the outer stage.
+	merge adds the time to the earlier row of the stage, so a stage timed in several pieces has one row per order
+	"""
+	timing = getattr(frappe.local, 'slife_timing', None)
+	if timing is None:
+		yield
+		return
+
+	outer, timing.current = timing.current, name
+	start_time = time.perf_counter()
+	with count_queries() as counter:
+		try:
+			yield
+		except Exception:
+			# The innermost stage that raised
+			timing.failed = timing.failed or name
+			raise
+		finally:
+			timing.current = outer
+			row = frappe._dict(
+				stage=name,
+				duration=(time.perf_counter() - start_time) * 1000,
+				queries=counter.count,
+				query_time=counter.seconds * 1000
+			)
+			earlier = merge and next((other for other in timing.stages if other.stage == name), None)
+			if earlier:
+				for field in ('duration', 'queries', 'query_time'):
+					earlier[field] += row[field]
+			else:
+				timing.stages.append(row)
+			if outer is None:
+				timing.queries += counter.count
+				timing.query_time += counter.seconds * 1000
+
+@contextmanager
+def timed(module, attribute, name):
+	"Time the calls of a module function made in the block as one merged stage, e.g. erpnext code called by insert()"
+	function = getattr(module, attribute, None)
+	if function is None or getattr(frappe.local, 'slife_timing', None) is None:
+		yield
+		return
+
+	def timed_function(*args, **kwargs):
+		with stage(name, merge=True):
+			return function(*args, **kwargs)
+
+	setattr(module, attribute, timed_function)
+	try:
+		yield
+	finally:
+		setattr(module, attribute, function)
+
+def current_stage():
+	"The name of the stage running now, e.g. to report where an order failed"
+	timing = getattr(frappe.local, 'slife_timing', None)
+	return timing.current if timing else None
+
+def failed_stage():
+	"The name of the innermost stage that raised since start(), e.g. to report where an order failed"
+	timing = getattr(frappe.local, 'slife_timing', None)
+	return timing.failed if timing else None
+
+def record(order_key=None, sales_order=None, inbox=None, job='order'):
+	"Save the stages timed since start() in a Woocommerce Order Timing, job is the stage field of a stage job"
+	from slife.slife.cache import get_settings
+
+	timing = getattr(frappe.local, 'slife_timing', None)
+	frappe.local.slife_timing = None
+	if timing is None or not get_settings().record_timings:
+		return
+
+	doc = frappe.get_doc({
+		'doctype': 'Woocommerce Order Timing',
+		'order_key': order_key,
+		'sales_order': sales_order,
+		'inbox': inbox,
+		'job': job,
+		'duration': (time.perf_counter() - timing.start) * 1000,
+		'queries': timing.queries,
+		'query_time': timing.query_time,
+		'stages': timing.stages
+	})
+	doc.insert(ignore_permissions=True)
+	return doc
+
+@contextmanager
+def count_queries():
+	"Count the queries and total query seconds of frappe.db.sql calls in the block"
+	counter = frappe._dict(count=0, seconds=0.0)
+	sql = frappe.db.sql
+
+	def counted_sql(*args, **kwargs):
+		start_time = time.perf_counter()
+		try:
+			return sql(*args, **kwargs)
+		finally:
+			counter.count += 1
+			counter.seconds += time.perf_counter() - start_time
+
+	frappe.db.sql = counted_sql
+	try:
+		yield counter
+	finally:
+		frappe.db.sql = sql
+
+def percentiles(values):
+	"Nearest rank p50, p95 and p99 of the values"
+	values = sorted(values)
+	if not values:
+		return {}
+	return {f'p{p}': values[max(0, math.ceil(p / 100 * len(values)) - 1)] for p in (50, 95, 99)}
@@ -0,0 +1,115 @@
+# Copyright (c) 2022, Slife
+# For license information, please see license.txt
+
+"""
+Warm-up of web and background worker processes, once per process and site. Imports the modules
+the order pipeline imports lazily, loads the DocType meta it uses and primes the slife caches, so
+the first order after a deploy or worker restart runs at steady-state latency.
+The time taken is logged to the slife log and recorded as the warm_up stage of the first order,
+see timing.
+"""
+
+import importlib
+import time
+
+import frappe
+
+MODULES = [
+	'difflib',
+	'erpnext.erpnext_integrations.connectors.woocommerce_connection',
+	'erpnext.setup.utils',
+	'erpnext.selling.doctype.sales_order.sales_order',
+	'erpnext.accounts.doctype.sales_invoice.sales_invoice',
+	'erpnext.stock.doctype.material_request.material_request',
+	'erpnext.buying.doctype.request_for_quotation.request_for_quotation',
+	'erpnext.controllers.accounts_controller',
+	'erpnext.stock.get_item_details',
+	'erpnext.accounts.doctype.pricing_rule.pricing_rule',
+	'erpnext.stock.doctype.item.item',
+	'frappe.contacts.doctype.address.address',
+	'frappe.contacts.doctype.contact.contact',
+	'frappe.desk.form.utils',
+	'slife.slife.woocommerce',
+	'slife.slife.doctype.woocommerce_inbox.woocommerce_inbox',
+	'slife.slife.doctype.woocommerce_order_link.woocommerce_order_link',
+	'slife.slife.doctype.woocommerce_order_archive.woocommerce_order_archive',
+	'slife.slife.doctype.woocommerce_order_timing.woocommerce_order_timing'
+]
+
+DOCTYPES = [
+	'Sales Order', 'Sales Order Item', 'Sales Taxes and Charges', 'Sales Invoice', 'Sales Invoice Item',
+	'Item', 'Item Variant Attribute', 'Item Default', 'Address', 'Contact', 'Contact Email', 'Contact Phone',
+	'Customer', 'Dynamic Link', 'Material Request', 'Request for Quotation',
+	'Woocommerce Inbox', 'Woocommerce Order Link', 'Woocommerce Order Archive', 'Woocommerce Order Timing'
+]
+
+# Most recently modified variant templates loaded by background workers, see cache.get_item_template
+TEMPLATES = 20
+
+_warmed = set()
+
+def warm_up(worker=True):
+	"""
+	Warm up the current process for the site unless already done. Web processes only import modules and load meta,
+	background workers, which run the order pipeline, also prime the caches. Errors are logged, never raised.
+	Returns the time taken in ms, or None if the process was already warm.
+	"""
+	site = frappe.local.site
+	if (site, worker) in _warmed:
+		return None
+	_warmed.add((site, worker))
+
+	steps = [('imports', import_modules), ('meta', load_meta)]
+	if worker:
+		steps += [('caches', prime_caches), ('templates', load_templates)]
+	timings = {}
+	start = time.perf_counter()
+	try:
+		for step, func in steps:
+			step_start = time.perf_counter()
+			func()
+			timings[step] = (time.perf_counter() - step_start) * 1000
+	except Exception:
+		frappe.log_error(frappe.get_traceback(), "Slife Warm-up Error")
+	duration = (time.perf_counter() - start) * 1000
+
+	report = ', '.join(f'{step} {ms:.0f} ms' for step, ms in timings.items())
+	frappe.logger('slife').info(f'warm-up of {site} took {duration:.0f} ms ({report})')
+	return duration
+
+def warm_up_request():
+	"before_request hook: warm up web workers for the verify_request of the order webhook"
+	warm_up(worker=False)
+
+def warm_up_job(*args, **kwargs):
+	"before_job hook: warm up background workers"
+	warm_up()
+
+def import_modules():
+	for module in MODULES:
+		importlib.import_module(module)
+
+def load_meta():
+	for doctype in DOCTYPES:
+		frappe.get_meta(doctype)
+
+def prime_caches():
+	"Load the Woocommerce Settings, company values and today's exchange rates, see cache"
+	from slife.slife.cache import (get_company_value, get_default_country, get_default_warehouse,
+		get_settings, prewarm_exchange_rates)
+
+	company = get_settings().company
+	if not company:
+		return
+	for fieldname in ('default_currency', 'cost_center', 'payment_terms'):
+		get_company_value(company, fieldname)
+	get_default_warehouse(company)
+	get_default_country()
+	prewarm_exchange_rates()
+
+def load_templates():
+	from slife.slife.cache import get_item_template
+	for code in frappe.get_all('Item', filters={'has_variants': 1, 'disabled': 0},
+		pluck='name', order_by='modified desc', limit=TEMPLATES
+	):
+		get_item_template(code)
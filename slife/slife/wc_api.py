@@ -0,0 +1,53 @@
+# Copyright (c) 2022, Slife
+# For license information, please see license.txt
+
+"""
+Minimal client of the Woocommerce REST API (v3). Authenticates with the consumer key & secret
+of the Woocommerce Settings, over HTTPS as required by Woocommerce for basic authentication.
+"""
+
+import frappe
+
+API_PATH = '/wp-json/wc/v3/'
+PER_PAGE = 100
+
+class WoocommerceAPI:
+	"GET requests to the Woocommerce REST API, see get_api for the configured store"
+
+	def __init__(self, url, consumer_key, consumer_secret, timeout=30):
+		import requests
+		self.url = url.rstrip('/') + API_PATH
+		self.session = requests.Session()
+		self.session.auth = (consumer_key, consumer_secret)
+		self.timeout = timeout
+
+	def get(self, endpoint, **params):
+		"The decoded JSON response and the response headers of an endpoint, e.g. products/12/variations"
+		r = self.session.get(self.url + endpoint, params=params, timeout=self.timeout)
+		r.raise_for_status()
+		return r.json(), r.headers
+
+	def get_all(self, endpoint, **params):
+		"Yield every record of a list endpoint, requesting it page by page"
+		for records in self.get_pages(endpoint, **params):
+			yield from records
+
+	def get_pages(self, endpoint, **params):
+		"Yield the pages of a list endpoint, each a list of records"
+		page = 1
+		while True:
+			records, headers = self.get(endpoint, page=page, per_page=PER_PAGE, **params)
+			if records:
+				yield records
+			total_pages = int(headers.get('X-WP-TotalPages') or 0)
+			if not records or len(records) < PER_PAGE or page >= total_pages:
+				return
+			page += 1
+
+def get_api():
+	"A client of the store configured in Woocommerce Settings"
+	from slife.slife.cache import get_settings
+	settings = get_settings()
+	if not (settings.woocommerce_server_url and settings.api_consumer_key and settings.api_consumer_secret):
+		frappe.throw('Woocommerce Settings: the Server URL, API consumer key and secret are required for the REST API')
+	return WoocommerceAPI(settings.woocommerce_server_url, settings.api_consumer_key, settings.api_consumer_secret)
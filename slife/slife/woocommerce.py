@@ -7,8 +7,6 @@ from frappe import _
 # Compatible with WooCommerce 5.9.0 & 6.2.0
 # TODO: remove Woocommerce Supplier in preference to using the ERPNext item/item group configured default Supplier
 # TODO: add fee_lines to the Sales Order. See test_order_7.json
-# TODO: make generic endpoint to deal with new events with header x-wc-webhook-resource: order.status_changed & order.updated & coupon.created
-# TODO: speed up frontend by queueing orders in a background_job/scheduler queue?
 
 def settings_override(doc, method=None):
 	"Overwrite the default settings endpoint URL. Called from the Woocommerce Settings before_save event"
@@ -16,50 +14,176 @@ def settings_override(doc, method=None):
 
 @frappe.whitelist(allow_guest=True)
 def order(*args, **kwargs):
-	try:
-		_order(*args, **kwargs)
-	except Exception:
-		error_message = f"{frappe.get_traceback()}\n\n Request Data: \n{frappe.request.data.decode('utf8')}"
-		frappe.log_error(error_message, "WooCommerce Error")
-		raise
-
-woocommerce_settings = None
-def _order(*args, **kwargs):
-	global woocommerce_settings
-	import json
+	"Verify the webhook and queue it. Returns the Woocommerce Inbox name, the order is processed by a background worker"
+	import json, time
 	from erpnext.erpnext_integrations.connectors.woocommerce_connection import verify_request
+	from slife.slife.doctype.woocommerce_inbox.woocommerce_inbox import enqueue_request
 
 	if frappe.request and frappe.request.data:
+		start = time.perf_counter()
 		verify_request()
+		verify_time = (time.perf_counter() - start) * 1000
 		try:
-			order = json.loads(frappe.request.data)
+			json.loads(frappe.request.data)
 		except ValueError:
 			#woocommerce returns 'webhook_id=value' for the first request which is not JSON
-			order = frappe.request.data
-		event = frappe.get_request_header("x-wc-webhook-event")
+			return
+		return enqueue_request(verify_time)
+	# ignore empty requests
 
-	else:
-		# ignore empty requests
-		return
+# Seconds an email stays resolved to its contact and customer, see resolve_email
+EMAIL_CACHE_TTL = 60
 
-	woocommerce_settings = frappe.get_cached_doc("Woocommerce Settings")
-	if event == "created":
-		status = order.get('status')
-		if status in ('processing', 'pending', 'failed', 'on-hold'):
+woocommerce_settings = None
+def _order(payload, event, delivery_id=None, inbox=None, resource=None):
+	"""
+	Process a verified webhook payload in the current transaction, the caller commits. Runs in a background job, see Woocommerce Inbox.
+	Returns the Sales Order of a created order, None if the event didn't create one
+	"""
+	global woocommerce_settings
+	import json
+	from slife.slife.cache import get_settings
+
+	handler = EVENT_HANDLERS.get((resource or 'order', event))
+	if not handler:
+		# e.g. order.deleted, coupon.created
+		return
+	woocommerce_settings = get_settings()
+	return handler(json.loads(payload), payload, delivery_id, inbox)
+
+# Statuses of new orders that create a Sales Order. completed is reached without a created event when the events
+# of an order are coalesced, or read by reconciliation or a bulk import
+NEW_ORDER_STATUSES = ('processing', 'pending', 'failed', 'on-hold', 'completed')
+
+def order_created(order, payload, delivery_id=None, inbox=None):
+	"Create the Sales Order, and unless pending the Sales Invoice & RFQ, for a new Woocommerce order. Returns the Sales Order"
+	from slife.slife.doctype.woocommerce_order_link.woocommerce_order_link import claim_order, update_order_link
+	from slife.slife.timing import record, stage
+
+	status = order.get('status')
+	if status in NEW_ORDER_STATUSES:
+		link = claim_order(order, delivery_id, inbox)
+		if not link:
+			# Duplicate delivery, the order already has a Sales Order
+			return
+
+		with stage('get_customer_by_email'):
 			customer = get_customer_by_email(order)
+		with stage('get_items'):
 			items = get_items(order)
-			sales_order = create_sales_order(order, customer, items)
-
-			if status != 'pending':
-				sales_order.submit()
-				sales_invoice = create_sales_invoice(order, sales_order)
-				if woocommerce_settings.orders_outsourced:
-					rfq = create_rfq(order, sales_order)
-				# Will not allow creation of sales invoice or material request if sales order is On Hold or Closed
-				update_sales_order_status(status, sales_order)
-		# Do nothing on cancelled, completed & refunded
-
-def create_rfq(order, sales_order):
+		with stage('create_sales_order'):
+			sales_order = create_sales_order(order, customer, items, payload)
+		update_order_link(link, sales_order=sales_order.name)
+
+		update_order_link(link, **order_state(order))
+		if status != 'pending':
+			submit_order(sales_order, link)
+		record(order.get('order_key'), sales_order.name, inbox)
+		return sales_order
+	# Do nothing on cancelled & refunded
+
+def order_updated(order, payload, delivery_id=None, inbox=None):
+	"Move the documents of an existing order to its new Woocommerce status, without rebuilding them"
+	from slife.slife.doctype.woocommerce_order_link.woocommerce_order_link import get_order_link, update_order_link
+	from slife.slife.timing import record, stage
+
+	# Waits for a running stage job, which holds the link, so its stage_status is current
+	link = get_order_link(order.get('order_key'), for_update=True)
+	if not link or not link.sales_order:
+		# The created webhook was missed or failed, treat the update as a new order
+		return order_created(order, payload, delivery_id, inbox)
+
+	state = order_state(order)
+	if state['checksum'] == link.checksum:
+		# Redelivered or nothing the integration uses has changed
+		return
+	if link.date_modified and state['date_modified'] and state['date_modified'] < link.date_modified:
+		# Delivered out of order, a newer update was already applied
+		return
+
+	status = order.get('status')
+	sales_order = frappe.get_doc('Sales Order', link.sales_order)
+	status_changed = status != link.wc_status
+	update_order_link(link, **state)
+	if sales_order.docstatus == 0:
+		if status in ('processing', 'failed', 'on-hold', 'completed'):
+			submit_order(sales_order, link)
+	elif sales_order.docstatus == 1 and status_changed and link.stage_status != 'Queued':
+		# While stages are queued they apply the status once done
+		with stage('apply_status'):
+			apply_status(link, sales_order)
+	record(order.get('order_key'), sales_order.name, inbox)
+
+# Webhook handlers by (x-wc-webhook-resource, x-wc-webhook-event)
+EVENT_HANDLERS = {
+	('order', 'created'): order_created,
+	('order', 'updated'): order_updated,
+	('order', 'restored'): order_updated,
+}
+
+def submit_order(sales_order, link):
+	"Submit the Sales Order and queue the jobs creating its Sales Invoice & RFQ, see Woocommerce Order Link STAGES"
+	from slife.slife.doctype.woocommerce_order_link.woocommerce_order_link import queue_stages
+	from slife.slife.timing import stage
+
+	with stage('submit'):
+		sales_order.submit()
+	queue_stages(link)
+
+def invoice_stage(link):
+	"Stage job: create the Sales Invoice of a submitted order"
+	from slife.slife.doctype.woocommerce_order_link.woocommerce_order_link import update_order_link
+	from slife.slife.timing import stage
+
+	with stage('create_sales_invoice'):
+		sales_order = frappe.get_doc('Sales Order', link.sales_order)
+		sales_invoice = create_sales_invoice(sales_order, link.wc_status)
+	update_order_link(link, sales_invoice=sales_invoice.name)
+
+def rfq_stage(link):
+	"Stage job: create the Material Request & RFQ of a submitted order"
+	global woocommerce_settings
+	from slife.slife.cache import get_settings
+	from slife.slife.doctype.woocommerce_order_link.woocommerce_order_link import update_order_link
+	from slife.slife.timing import stage
+
+	woocommerce_settings = get_settings()
+	with stage('create_rfq'):
+		rfq = create_rfq(frappe.get_doc('Sales Order', link.sales_order))
+	update_order_link(link,
+		material_request=rfq.items[0].material_request,
+		request_for_quotation=rfq.name
+	)
+
+def apply_status(link, sales_order):
+	"Mimic the Woocommerce status of the link on the submitted Sales Order & Sales Invoice"
+	if link.wc_status in ('processing', 'completed') and link.sales_invoice:
+		sales_invoice = frappe.get_doc('Sales Invoice', link.sales_invoice)
+		if sales_invoice.docstatus == 0:
+			sales_invoice.submit()
+	update_sales_order_status(link.wc_status, sales_order)
+
+def order_state(order):
+	"The Woocommerce Order Link fields recording the last applied payload of an order"
+	return {
+		'wc_status': order.get('status'),
+		'date_modified': order.get('date_modified'),
+		'checksum': order_checksum(order)
+	}
+
+def order_checksum(order):
+	"Compact checksum of the order fields used by the integration, to detect changed orders"
+	import hashlib, json
+
+	data = [
+		order.get('status'), order.get('date_modified'), order.get('currency'), order.get('total'),
+		order.get('billing'), order.get('shipping'),
+		[(line.get('id'), line.get('sku'), line.get('quantity'), line.get('total')) for line in order.get('line_items') or []],
+		[coupon.get('code') for coupon in order.get('coupon_lines') or []]
+	]
+	return hashlib.md5(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+def create_rfq(sales_order):
 	"Create a draft RFQ from a Material Request"
 	from erpnext.selling.doctype.sales_order.sales_order import make_material_request
 	from erpnext.stock.doctype.material_request.material_request import make_request_for_quotation
@@ -78,26 +202,31 @@ def create_rfq(order, sales_order):
 
 	rfq.rfq_number = sales_order.po_no
 	rfq.email_template = woocommerce_settings.rfq_email_template
+	for item in rfq.items:
+		item.rfq_number = sales_order.po_no
 	rfq.insert()
 	return rfq
 
-def create_sales_invoice(order, sales_order):
-	"Create the Sales Invoice. processing: submitted. (pending, failed, on-hold): draft"
+def create_sales_invoice(sales_order, status):
+	"Create the Sales Invoice. processing, completed: submitted. (pending, failed, on-hold): draft"
 	from erpnext.selling.doctype.sales_order.sales_order import make_sales_invoice
 
 	sales_invoice = make_sales_invoice(sales_order.name)
 	sales_invoice.insert()
-	if order.get('status') == 'processing':
+	if status in ('processing', 'completed'):
 		sales_invoice.submit()
 	return sales_invoice
 
-def create_sales_order(order, customer, items):
+def create_sales_order(order, customer, items, payload):
 	"Create a new sales order"
-	from erpnext.setup.utils import get_exchange_rate
-	company_currency = frappe.get_cached_value('Company', woocommerce_settings.company, "default_currency")
+	from erpnext.controllers import accounts_controller
+	from slife.slife.cache import get_company_value, get_exchange_rate
+	from slife.slife.doctype.woocommerce_order_archive.woocommerce_order_archive import archive_order
+	from slife.slife.timing import stage, timed
+	company_currency = get_company_value(woocommerce_settings.company, "default_currency")
 
 	sales_order = frappe.new_doc("Sales Order")
-	sales_order.customer = customer.name
+	sales_order.customer = customer
 	sales_order.naming_series = woocommerce_settings.sales_order_series or "SO-WOO-.#####"
 
 	created_date = order.get("date_created").split("T")
@@ -109,12 +238,13 @@ def create_sales_order(order, customer, items):
 
 	sales_order.company = woocommerce_settings.company
 	sales_order.currency = order.get("currency")
-	sales_order.conversion_rate = get_exchange_rate(order.get("currency"), company_currency)
-	sales_order.coupon_code = order.get("coupon_lines")[0].get("code") if order.get("coupon_lines") else None
-	sales_order.woocommerce_order_json = frappe.request.data.decode('utf8')
+	sales_order.conversion_rate = get_exchange_rate(order.get("currency"), company_currency, sales_order.transaction_date)
+	# One apply_discount row per order, with the pricing rule applied by insert() below
+	with stage('apply_discount', merge=True):
+		set_coupon(order, sales_order)
 
 	sales_order.source = woocommerce_settings.lead_source
-	sales_order.payment_terms_template = order.get("payment_method") or frappe.db.get_value('Company', woocommerce_settings.company, 'payment_terms')
+	sales_order.payment_terms_template = order.get("payment_method") or get_company_value(woocommerce_settings.company, 'payment_terms')
 
 	# !important
 	sales_order.set_missing_values()
@@ -122,26 +252,45 @@ def create_sales_order(order, customer, items):
 
 	#print(sales_order.as_dict())
 	#sales_order.validate()
-	sales_order.insert()
-	frappe.db.commit()
+	# erpnext applies the coupon's transaction pricing rule when validating
+	with timed(accounts_controller, 'apply_pricing_rule_on_transaction', 'apply_discount'):
+		sales_order.insert()
+	archive_order(sales_order.name, payload, order.get("order_key"))
 	return sales_order
 
+def set_coupon(order, sales_order):
+	"""
+	Set the first active coupon of the order's coupon lines, erpnext applies one coupon per Sales Order.
+	Every Woocommerce code is kept in woocommerce_coupons, unknown and expired codes are skipped
+	"""
+	from slife.slife.cache import get_active_coupon
+
+	codes = [line.get("code") for line in order.get("coupon_lines") or [] if line.get("code")]
+	sales_order.woocommerce_coupons = ", ".join(codes) or None
+	sales_order.coupon_code = get_active_coupon(codes, sales_order.company, sales_order.transaction_date) if codes else None
+
 def update_sales_order_status(status, sales_order):
 	"""
 	Mimic WC statuses:
 	pending - draft
 	processing - submitted
 	on-hold - submitted & On Hold
-	failed - submitted & Closed
+	failed, cancelled - submitted & Closed
+	processing, completed - submitted, resumed if On Hold or Closed by an earlier status
 	"""
 	from frappe.desk.form.utils import add_comment
 
 	if 'hold' in status:
 		doc_status = 'On Hold'
-	elif 'fail' in status:
+	elif 'fail' in status or 'cancel' in status:
 		doc_status = 'Closed'
+	elif status in ('processing', 'completed') and sales_order.status in ('On Hold', 'Closed'):
+		# Draft makes ERPNext recalculate the status from deliveries & billing
+		doc_status = 'Draft'
 	else:
 		return
+	if sales_order.status == doc_status:
+		return
 
 	add_comment(
 		reference_doctype=sales_order.doctype,
@@ -154,15 +303,15 @@ def update_sales_order_status(status, sales_order):
 
 def add_sales_order_items(order, sales_order, items):
 	from frappe.utils import flt
-	from erpnext.controllers.accounts_controller import add_taxes_from_tax_template, set_child_tax_template_and_map
-	from erpnext.accounts.doctype.pricing_rule.pricing_rule import apply_pricing_rule
+	from slife.slife.cache import get_accounts_setting, get_company_value, get_item_tax
 
+	items_by_code = {}
+	for item in items:
+		items_by_code.setdefault(item.item_code, item)
+
+	rows = []
 	for item_data in order.get("line_items"):
-		item = None
-		for match in items:
-			if item_data.get('erpnext_item_code') == match.item_code:
-				item = match
-				break
+		item = items_by_code[item_data.get('erpnext_item_code')]
 
 		qty = flt(item_data.get("quantity"))
 		subtotal = flt(item_data.get("subtotal"))
@@ -176,21 +325,52 @@ def add_sales_order_items(order, sales_order, items):
 		})
 
 		sales_order.append('items', so_item)
-		# !important
-		sales_order.set_missing_item_details()
-		set_child_tax_template_and_map(item, so_item, sales_order)
-		add_taxes_from_tax_template(so_item, sales_order)
-		# !important
+		rows.append((item, so_item))
+
+	# !important
+	# Once for the whole order, each call recomputes every row
+	sales_order.set_missing_item_details()
+	# As erpnext set_child_tax_template_and_map & add_taxes_from_tax_template, resolved from the cache
+	add_taxes = get_accounts_setting('add_taxes_from_item_tax_template')
+	tax_rates = set()
+	for item, so_item in rows:
+		template, tax_rate = get_item_tax(item.taxes, sales_order.tax_category, sales_order.company,
+			sales_order.transaction_date)
+		so_item.item_tax_template = template
+		if template:
+			so_item.item_tax_rate = tax_rate
+		# Tax rows are only added for missing tax heads so each distinct tax map is applied once
+		if add_taxes and so_item.item_tax_rate and so_item.item_tax_rate not in tax_rates:
+			tax_rates.add(so_item.item_tax_rate)
+			add_item_taxes(sales_order, so_item.item_tax_rate)
+	# !important
 
 	add_tax_details(sales_order, order.get("shipping_total"), "Shipping Charge", woocommerce_settings.f_n_f_account)
 	add_tax_details(sales_order, order.get("shipping_tax"), "Shipping Tax", woocommerce_settings.tax_account)
 
 	# Hack fix of ERPNext bug #29871
-	cost_center = frappe.get_value('Company', sales_order.company, 'cost_center')
+	cost_center = get_company_value(sales_order.company, 'cost_center')
 	for tax in sales_order.taxes:
 		tax.cost_center = cost_center
 	#print(sales_order.as_dict())
 
+def add_item_taxes(sales_order, item_tax_rate):
+	"Add an On Net Total tax row for each tax head of an item tax map the order does not have yet"
+	import json
+	from frappe.utils import flt
+
+	tax_map = json.loads(item_tax_rate)
+	heads = {tax.account_head for tax in sales_order.get('taxes')}
+	for tax_type, rate in tax_map.items():
+		if tax_type not in heads:
+			sales_order.append("taxes", {
+				"description": str(tax_type).split(' - ')[0],
+				"charge_type": "On Net Total",
+				"account_head": tax_type,
+				"rate": flt(rate)
+			})
+			heads.add(tax_type)
+
 def add_tax_details(sales_order, price, desc, tax_account_head):
 	sales_order.append("taxes", {
 		"charge_type":"Actual",
@@ -219,152 +399,283 @@ def attribute_value(key, org):
 	return value, f'{key}:{human}'
 
 def get_items(order):
-	"Get or create order items. Variants have attributes, normal items do not"
-	from erpnext.controllers.item_variant import copy_attributes_to_variant
-	default_wh = frappe.get_value('Warehouse', {'company': woocommerce_settings.company, 'name': ('like', 'Stores%')}, 'name')
-	meta_prefix = woocommerce_settings.attribute_key_prefix
+	"""
+	Get or create order items. Variants have attributes, normal items do not.
+	All item docs are built in memory first, existing items are found with one query
+	and only the missing items are inserted. Items are usually created beforehand, see catalog.
+	"""
+	from slife.slife.cache import get_default_warehouse
+	default_wh = get_default_warehouse(woocommerce_settings.company)
+
 	items = []
 	for item in order.get('line_items'):
-		doc = frappe.new_doc('Item')
-		code = item.get('sku')
-
-		attributes = {}
-		template = None
-		for meta in item.get('meta_data'):
-			if meta['key'].startswith(meta_prefix):
-				if not template:
-					template = frappe.get_doc('Item', {'name': code, 'has_variants': True})
-					template_attributes = [attr.attribute for attr in template.attributes]
-
-				key = meta['key'][len(meta_prefix):]
-				# Skip attribute if not in template
-				if key not in template_attributes:
-					continue
-
-				value, disp = attribute_value(key, meta['value'])
-
-				# Save for later addition to code and name in consistent sorted order
-				attributes[key] = (value, disp, meta['value'])
-
-				attribute_doc = frappe.new_doc('Item Variant Attribute')
-				attribute_doc.variant_of = code
-				attribute_doc.attribute = key
-				attribute_doc.attribute_value = value
-				doc.append('attributes', attribute_doc)
-
-		# Test if the item is a variant
-		if template:
-			copy_attributes_to_variant(template, doc)
-			name = template.get('item_name')
-			for key in sorted(attributes):
-				code += f'-{attributes[key][0]}'
-				name += f' {attributes[key][1]}'
-		else:
-			doc.item_group = woocommerce_settings.item_group
-			doc.stock_uom = woocommerce_settings.uom or "Nos"
-			doc.sales_uom = doc.stock_uom
-			doc.is_stock_item = False
-			doc.append("item_defaults", {
-				"company": woocommerce_settings.company,
-				"default_warehouse": woocommerce_settings.warehouse or default_wh
-			})
-			name = item.get('name')
-			description = f'<p>{name}</p>'
-			doc.description = f'<div>{description}</div>'
+		doc = make_item(item, default_wh)
+		items += [doc]
+		# used in add_sales_order_items:
+		item['erpnext_item_code'] = doc.item_code
 
-		doc.item_code = code
-		doc.item_name = name
+	insert_missing_items(items)
+	return items
 
+def insert_missing_items(items):
+	"""
+	Name the Item docs that exist, found with one query, and insert the others. Also used by the catalog sync.
+	Items aren't locked: an Item inserted meanwhile by a concurrent order is read back instead
+	"""
+	codes = list({doc.item_code for doc in items})
+	if not codes:
+		return
+	names = dict(frappe.get_all('Item', filters={'item_code': ('in', codes)}, fields=['item_code', 'name'], as_list=True))
+	for doc in items:
+		if doc.item_code in names:
+			doc.name = names[doc.item_code]
+			continue
+		frappe.db.savepoint('slife_item')
 		try:
 			doc.insert()
 		except frappe.DuplicateEntryError:
-			pass
-		items += [doc]
-		# used in add_sales_order_items:
-		item['erpnext_item_code'] = code
-	frappe.db.commit()
-	return items
+			frappe.db.rollback(save_point='slife_item')
+			# A locking read sees the Item committed after this transaction's snapshot
+			doc.name = frappe.db.get_value('Item', {'item_code': doc.item_code}, 'name', for_update=True)
+			if not doc.name:
+				raise
+		names[doc.item_code] = doc.name
+
+def make_item(item, default_wh):
+	"Build an unsaved Item doc for a Woocommerce line item"
+	from slife.slife.cache import get_item_template
+	meta_prefix = woocommerce_settings.attribute_key_prefix
+	doc = frappe.new_doc('Item')
+	code = item.get('sku')
+
+	attributes = {}
+	template = None
+	for meta in item.get('meta_data'):
+		if meta['key'].startswith(meta_prefix):
+			if not template:
+				template = get_item_template(code)
+
+			key = meta['key'][len(meta_prefix):]
+			# Skip attribute if not in template
+			if key not in template.attributes:
+				continue
+
+			value, disp = attribute_value(key, meta['value'])
+
+			# Save for later addition to code and name in consistent sorted order
+			attributes[key] = (value, disp, meta['value'])
+
+			attribute_doc = frappe.new_doc('Item Variant Attribute')
+			attribute_doc.variant_of = code
+			attribute_doc.attribute = key
+			attribute_doc.attribute_value = value
+			doc.append('attributes', attribute_doc)
+
+	# Test if the item is a variant
+	if template:
+		copy_template_to_variant(template, doc)
+		name = template.item_name
+		for key in sorted(attributes):
+			code += f'-{attributes[key][0]}'
+			name += f' {attributes[key][1]}'
+	else:
+		doc.item_group = woocommerce_settings.item_group
+		doc.stock_uom = woocommerce_settings.uom or "Nos"
+		doc.sales_uom = doc.stock_uom
+		doc.is_stock_item = False
+		doc.append("item_defaults", {
+			"company": woocommerce_settings.company,
+			"default_warehouse": woocommerce_settings.warehouse or default_wh
+		})
+		name = item.get('name')
+		description = f'<p>{name}</p>'
+		doc.description = f'<div>{description}</div>'
+
+	doc.item_code = code
+	doc.item_name = name
+	return doc
+
+def copy_template_to_variant(template, variant):
+	"In-memory equivalent of erpnext copy_attributes_to_variant using cached template metadata"
+	from frappe.utils import cstr
+
+	for fieldname, value in template.copy_fields.items():
+		if isinstance(value, list):
+			variant.set(fieldname, [])
+			for row in value:
+				variant.append(fieldname, row.copy())
+		else:
+			variant.set(fieldname, value)
+
+	variant.variant_of = template.name
+
+	if not template.copy_description:
+		if not variant.description:
+			variant.description = ""
+	elif template.variant_based_on == 'Item Attribute' and variant.attributes:
+		attributes_description = (template.description or "") + " "
+		for d in variant.attributes:
+			attributes_description += "<div>" + d.attribute + ": " + cstr(d.attribute_value) + "</div>"
+
+		if attributes_description not in (variant.description or ""):
+			variant.description = attributes_description
 
 def get_customer_by_email(order):
-	"Get or create customer doc with addresses and contact by email"
-	contact = get_contact_by_email(order)
+	"""
+	Get or create the customer with addresses and contact by email. Returns the customer name.
+	The Contact and Customer docs are only loaded when something needs to be written.
+	"""
+	from frappe.utils import cstr
+	from slife.slife.timing import stage
+
+	email = order.get("billing").get("email").strip()
+	resolved = resolve_email(email)
+	contact = get_contact_by_email(order, resolved)
 
 	customer = {
 		'customer_type': 'Company' if order.get("billing").get("company").strip() else 'Individual',
 		'customer_name': (order.get("billing").get("company").strip() or
 			f'{order.get("billing").get("first_name")} {order.get("billing").get("last_name")}'.strip()),
 		'tax_category': woocommerce_settings.customer_tax_category,
-		'customer_primary_contact': contact.name
+		'customer_primary_contact': contact
 	}
 
-	customer_names = frappe.db.get_all('Dynamic Link',
-		filters={'parenttype': 'Contact', 'parent': contact.name, 'link_doctype': 'Customer'},
-		pluck='link_name'
-	)
-	if customer_names:
-		doc = frappe.get_doc('Customer', customer_names[0])
-		doc.update(customer)
+	if resolved and resolved.customer:
+		name = resolved.customer
 	else:
 		doc = frappe.new_doc('Customer')
 		doc.update(customer)
 		doc.insert()
-		contact.append("links", {
+		name = doc.name
+		doc_contact = frappe.get_doc('Contact', contact)
+		doc_contact.append("links", {
 			"link_doctype": "Customer",
-			"link_name": doc.name
+			"link_name": name
 		})
 		# Already inserted, just updating the links:
-		contact.save()
+		doc_contact.save()
+		resolved = None
 
-	add_addresses(order, doc)
-	doc.save()
-	frappe.db.commit()
-	return doc
-
-def add_addresses(order, doc_customer):
-	"Append new addresses to the customer doc"
-	default_country = frappe.db.get_single_value('System Settings', 'country')
+	with stage('add_addresses'):
+		primary_address = add_addresses(order, name, customer['customer_name'])
+	if primary_address:
+		customer['customer_primary_address'] = primary_address
 
-	address_names = frappe.db.get_all('Dynamic Link',
-		filters={'parenttype': 'Address', 'link_doctype': 'Customer', 'link_name': doc_customer.name},
-		pluck='parent', order_by='parent asc'
-	)
+	if not resolved or any(cstr(resolved.get(field)) != cstr(value) for field, value in customer.items()):
+		# Saving an address can update the customer so always load it afterwards
+		doc = frappe.get_doc('Customer', name)
+		doc.update(customer)
+		doc.save()
+		clear_email_cache(email)
+	return name
 
+def resolve_email(email):
+	"""
+	The contact, its customer and their current field values for an email in one query, or None.
+	Contacts with a customer are cached for EMAIL_CACHE_TTL seconds by normalised email.
+	"""
+	key = f'slife_email:{email.lower()}'
+	resolved = frappe.cache().get_value(key)
+	if resolved:
+		return frappe._dict(resolved)
+
+	resolved = frappe.db.sql("""select
+			contact.name as contact, contact.first_name, contact.last_name,
+			contact.is_primary_contact, contact.is_billing_contact,
+			customer.name as customer, customer.customer_type, customer.customer_name, customer.tax_category,
+			customer.customer_primary_contact, customer.customer_primary_address
+		from `tabContact Email` contact_email
+		inner join `tabContact` contact on contact.name = contact_email.parent
+		left join `tabDynamic Link` link on link.parenttype = 'Contact' and link.parent = contact.name
+			and link.link_doctype = 'Customer'
+		left join `tabCustomer` customer on customer.name = link.link_name
+		where contact_email.email_id = %s and contact_email.parenttype = 'Contact'
+		order by contact_email.modified desc, link.modified desc
+		limit 1""", email, as_dict=True)
+	if resolved:
+		if resolved[0].customer:
+			frappe.cache().set_value(key, resolved[0], expires_in_sec=EMAIL_CACHE_TTL)
+		return resolved[0]
+
+def clear_email_cache(email):
+	frappe.cache().delete_value(f'slife_email:{email.lower()}')
+
+def add_addresses(order, customer, customer_name):
+	"Add or update the order addresses of the customer. Returns the billing address name if there is one"
+	from slife.slife.cache import get_country, get_default_country
+	default_country = get_default_country()
+
+	inserted = []
+	primary_address = None
 	for address_type in ['Billing', 'Shipping']:
 		address = order.get(address_type.lower())
 		if address.get('address_1').strip():
 			data = {
-				'country': frappe.get_value("Country", {"code": address.get("country").lower()}) or default_country,
+				'country': get_country(address.get("country").lower()) or default_country,
 				'pincode': address.get('postcode'),
 				'state': address.get('state'),
 				'city': address.get('city'),
 				'address_line2': address.get('address_2'),
 				'address_line1': address.get('address_1'),
 				'address_type': address_type,
-				'address_title': doc_customer.customer_name,
+				'address_title': customer_name,
 				'is_primary_address': 1 if address_type == 'Billing' else 0,
 				'is_shipping_address': 1 if address_type == 'Shipping' or order.get('shipping').get('address_1').strip() == '' else 0,
 				'links': [{
 					'link_doctype': 'Customer',
-					'link_name': doc_customer.name
+					'link_name': customer
 				}]
 			}
 
 			doc = frappe.new_doc('Address')
 			doc.update(data)
-			for name in address_names:
-				existing = frappe.get_doc('Address', name)
-				if same_address(doc, existing):
-					existing.update(data)
-					doc = existing
-					doc.save()
-					break
+			existing = find_address(doc, customer, exclude=inserted)
+			if existing:
+				doc = frappe.get_doc('Address', existing)
+				doc.update(data)
+				doc.save()
 			else:
 				doc.insert()
+				inserted.append(doc.name)
 
-			doc_customer.reload()
 			if address_type == 'Billing':
-				doc_customer.customer_primary_address = doc.name
-	frappe.db.commit()
+				primary_address = doc.name
+
+	return primary_address
+
+def find_address(new, customer, exclude=None):
+	"""
+	Name of the first customer address that is the same_address as the new one or None.
+	Only addresses with the same indexed address key (postcode + country) are compared.
+	"""
+	filters = [
+		['Dynamic Link', 'parenttype', '=', 'Address'],
+		['Dynamic Link', 'link_doctype', '=', 'Customer'],
+		['Dynamic Link', 'link_name', '=', customer]
+	]
+	if exclude:
+		filters.append(['name', 'not in', exclude])
+	# Without a key same_address matches any address
+	key = new.address_line1.strip() and address_key(new.pincode, new.country)
+	if key:
+		filters.append(['woocommerce_address_key', '=', key])
+
+	candidates = frappe.get_all('Address', filters=filters,
+		fields=['name', 'address_line1', 'pincode', 'country'], order_by='name asc')
+	for existing in candidates:
+		if same_address(new, existing):
+			return existing.name
+
+def address_key(pincode, country):
+	"Postcode and country normalised as same_address compares them. Stored and indexed on Address"
+	pincode = (pincode or '').lower().replace(' ', '')
+	country = (country or '').lower().replace(' ', '')
+	if pincode and country:
+		return f'{pincode}|{country}'
+
+def set_address_key(doc, method=None):
+	"Called from the Address validate event"
+	doc.woocommerce_address_key = address_key(doc.pincode, doc.country)
 
 def same_address(new, existing):
 	"See if there's a first line + postcode + country address match with the existing address"
@@ -381,8 +692,13 @@ def same_address(new, existing):
 	# Keep the existing address if something is missing:
 	return True
 
-def get_contact_by_email(order):
-	"Look for an email match on Contact Email and get the parent Contact or create new"
+def get_contact_by_email(order, resolved=None):
+	"""
+	Get the Contact found by resolve_email, saving it if the order changes its details, or create new.
+	Returns the contact name
+	"""
+	from frappe.utils import cint, cstr
+
 	email = {
 		'email_id': order.get("billing").get("email").strip(),
 		'is_primary': True
@@ -397,22 +713,22 @@ def get_contact_by_email(order):
 		'is_primary_contact': True,
 		'is_billing_contact': True
 	}
-	contact_names = frappe.db.get_all('Contact Email',
-		filters={'email_id': email['email_id'], 'parenttype': 'Contact'},
-		pluck='parent'
-	)
-	if contact_names:
-		doc = frappe.get_doc('Contact', contact_names[0])
-		doc.update(contact)
-		doc.save()
-	else:
-		doc = frappe.new_doc('Contact')
-		doc.update(contact)
-		doc_email = frappe.new_doc('Contact Email')
-		doc_email.update(email)
-		doc_phone = frappe.new_doc('Contact Phone')
-		doc_phone.update(phone)
-		doc.append('email_ids', doc_email)
-		doc.append('phone_nos', doc_phone)
-		doc.insert()
-	return doc
+	if resolved:
+		if (cstr(resolved.first_name) != contact['first_name'] or cstr(resolved.last_name) != contact['last_name']
+			or not cint(resolved.is_primary_contact) or not cint(resolved.is_billing_contact)):
+			doc = frappe.get_doc('Contact', resolved.contact)
+			doc.update(contact)
+			doc.save()
+			clear_email_cache(email['email_id'])
+		return resolved.contact
+
+	doc = frappe.new_doc('Contact')
+	doc.update(contact)
+	doc_email = frappe.new_doc('Contact Email')
+	doc_email.update(email)
+	doc_phone = frappe.new_doc('Contact Phone')
+	doc_phone.update(phone)
+	doc.append('email_ids', doc_email)
+	doc.append('phone_nos', doc_phone)
+	doc.insert()
+	return doc.name